@@ -1,166 +1,147 @@
 import streamlit as st
-import pandas as pd
-import plotly.express as px
 import plotly.graph_objects as go
 import json
-from model.db import DatabaseClient
+from datetime import datetime, timedelta
+from model.db import DatabaseClient, get_current_month_range, get_whole_month_range, RESOLUTIONS
+from model.downsample import lttb
 
 # JSONファイルを読み込む
 with open('config/user_color.json', 'r') as f:
     user_colors = json.load(f)
 
-# db: INSTANCE GENERATION
-db_client = DatabaseClient()
-
-# db: group_idを指定して所属する全てのユーザのuser_idを取得
-user_ids = []
-users = db_client.get_users_by_group(1)
-for user in users:
-    user_ids.append(user.user_id)
-
-# user_idをキーにした辞書に変換
-user_dict = {user.user_id: user.user_name for user in users}
-
-# db: userごとの今月のfit dataを取得
-fit_data_monthly_list = []  # 2重配列
-for user_id in user_ids:
-    fit_data_monthly = db_client.get_user_fit_data_for_current_month(user_id)
-    fit_data_monthly_list.append(fit_data_monthly)
-
-# データをフラットにしてDataFrameに変換
-fit_data_flat = []
-for sublist in fit_data_monthly_list:
-    for item in sublist:
-        fit_data_flat.append({
-            'user_id': item.user_id,
-            'datetime': item.datetime,
-            'steps': item.steps,
-            'distance': item.distance,
-            'weight': item.weight,
-            'fat': item.fat
-        })
-
-# DataFrameに変換
-df = pd.DataFrame(fit_data_flat)
-# datetime列をdatetime型に変換
-df['datetime'] = pd.to_datetime(df['datetime'])
-# 各ユーザーごとに歩数と距離を累積計算
-df['cumulative_steps'] = df.groupby('user_id')['steps'].cumsum()
-df['cumulative_distance'] = df.groupby('user_id')['distance'].cumsum()
-
-# PlotlyのFigureを各データのグラフ用に作成
-fig_distance = go.Figure()
-fig_weight = go.Figure()
-fig_steps = go.Figure()
-fig_cumulative_distance = go.Figure()
-fig_cumulative_steps = go.Figure()
-
-# 各ユーザーごとに異なる線を追加
-for user_id, user_data in df.groupby('user_id'):
-    # user config
-    user_name = user_dict.get(user_id, 'who?')
-    color = user_colors.get(str(user_id), '#000000')
-    
-    # 体重のグラフ
-    fig_weight.add_trace(go.Scatter(
-        x=user_data['datetime'],
-        y=user_data['weight'],
-        mode='lines+markers',
-        name=f'{user_name}',
-        line=dict(color=color)
-    ))
-
-    # 歩数のグラフ
-    fig_steps.add_trace(go.Scatter(
-        x=user_data['datetime'],
-        y=user_data['steps'],
-        mode='lines+markers',
-        name=f'{user_name}',
-        line=dict(color=color)
-    ))
-    
-    # 距離のグラフ
-    fig_distance.add_trace(go.Scatter(
-        x=user_data['datetime'],
-        y=user_data['distance'],
-        mode='lines+markers',
-        name=f'{user_name}',
-        line=dict(color=color)
-    ))
-
-    # 累積歩数のグラフ
-    fig_cumulative_steps.add_trace(go.Scatter(
-        x=user_data['datetime'],
-        y=user_data['cumulative_steps'],
-        mode='lines+markers',
-        name=f'{user_name}',
-        line=dict(color=color)
-    ))
-    
-    # 累積距離のグラフ
-    fig_cumulative_distance.add_trace(go.Scatter(
-        x=user_data['datetime'],
-        y=user_data['cumulative_distance'],
-        mode='lines+markers',
-        name=f'{user_name}',
-        line=dict(color=color)
-    ))
-
-# 各グラフのタイトルとレイアウトを設定
-fig_weight.update_layout(
-    title='体重変動',
-    xaxis_title='Datetime',
-    yaxis_title='Weight [kg]',
-    legend=dict(orientation="h", 
-                yanchor="bottom", 
-                y=1.1, 
-                xanchor="center", 
-                x=0.5)
-    )
-
-fig_cumulative_steps.update_layout(
-    title='今月の累計歩数',
-    xaxis_title='Datetime',
-    yaxis_title='Cumulative Steps',
-    legend=dict(orientation="h", 
-                yanchor="bottom", 
-                y=1.1, 
-                xanchor="center", 
-                x=0.5)
-    )
-
-fig_steps.update_layout(
-    title='歩数',
-    xaxis_title='Datetime',
-    yaxis_title='Steps',
-    legend=dict(orientation="h", 
-                yanchor="bottom", 
-                y=1.1, 
-                xanchor="center", 
-                x=0.5)
-    )
-
-fig_cumulative_distance.update_layout(
-    title='今月の累計移動距離',
-    xaxis_title='Datetime',
-    yaxis_title='Cumulative Distance [km]',
-    legend=dict(orientation="h", 
-                yanchor="bottom", 
-                y=1.1, 
-                xanchor="center", 
-                x=0.5)
-    )
-
-fig_distance.update_layout(
-    title='移動距離',
-    xaxis_title='Datetime',
-    yaxis_title='Distance [km]',
-    legend=dict(orientation="h", 
-                yanchor="bottom", 
-                y=1.1, 
-                xanchor="center", 
-                x=0.5)
-    )
+# db: グループのデータが更新されたかを確認する軽いクエリ（主キーでの1行の取得）
+# 毎回問い合わせるので、書き込まれたらすぐに次の表示で反映される
+def get_data_version(group_id):
+    return DatabaseClient().get_fit_data_version(group_id)
+
+# db: group_idを指定して所属する全てのユーザのfit dataを、resolution(day/week/month)ごとにSQLで集計して取得
+# 累計もSQLのウィンドウ関数で計算するので、グラフに描く行だけを受け取る
+# 月単位の場合は月次集計(tbl_fit_monthly)から読む
+# data_versionが変わらない限り、キャッシュした結果を全セッションで使い回す
+@st.cache_data(max_entries=8)
+def load_fit_frame(group_id, start, end, resolution, data_version):
+    return DatabaseClient().get_group_fit_series(group_id, start, end, resolution)
+
+# 集計単位の表示名
+RESOLUTION_LABELS = {'day': '日', 'week': '週', 'month': '月'}
+
+# グラフ全体の点の数がこれを超えたらScattergl(WebGL)で描画する
+WEBGL_POINT_THRESHOLD = 2000
+# WebGLで描画する時に、ユーザごとの線を間引く点の数（ユーザが多い場合はグラフ全体でMAX_POINTS_PER_FIGUREまで）
+MAX_POINTS_PER_USER = 500
+MAX_POINTS_PER_FIGURE = 20000
+
+# ユーザの1本の線を作る
+# max_pointsがNoneの場合は間引かずにSVGで描画する
+def user_trace(user_data, column, user_name, color, max_points=None):
+    user_data = user_data[user_data[column].notna()]
+    x = user_data['datetime']
+    y = user_data[column]
+    if max_points is None:
+        return go.Scatter(x=x, y=y, mode='lines+markers', name=f'{user_name}', line=dict(color=color))
+    # LTTBで山や谷を残したまま間引き、マーカーは描かない
+    indices = lttb(x.to_numpy(dtype='datetime64[ns]').astype('int64'), y.to_numpy(), max_points)
+    return go.Scattergl(x=x.iloc[indices], y=y.iloc[indices], mode='lines', name=f'{user_name}', line=dict(color=color))
+
+# グラフもdata_versionごとにキャッシュする
+@st.cache_data(max_entries=8)
+def build_figures(group_id, start, end, resolution, data_version):
+    df = load_fit_frame(group_id, start, end, resolution, data_version)
+
+    # PlotlyのFigureを各データのグラフ用に作成
+    fig_distance = go.Figure()
+    fig_weight = go.Figure()
+    fig_steps = go.Figure()
+    fig_cumulative_distance = go.Figure()
+    fig_cumulative_steps = go.Figure()
+
+    # 点が多い場合はWebGLで描画し、各ユーザの線をLTTBで間引いてブラウザに送る点の数を抑える
+    max_points = None
+    if len(df) > WEBGL_POINT_THRESHOLD:
+        max_points = max(3, min(MAX_POINTS_PER_USER, MAX_POINTS_PER_FIGURE // max(1, df['user_id'].nunique())))
+
+    # 各ユーザーごとに異なる線を追加
+    for (user_id, user_name), user_data in df.groupby(['user_id', 'user_name']):
+        # user config
+        color = user_colors.get(str(user_id), '#000000')
+
+        # 体重のグラフ
+        fig_weight.add_trace(user_trace(user_data, 'weight', user_name, color, max_points))
+
+        # 歩数のグラフ
+        fig_steps.add_trace(user_trace(user_data, 'steps', user_name, color, max_points))
+
+        # 距離のグラフ
+        fig_distance.add_trace(user_trace(user_data, 'distance', user_name, color, max_points))
+
+        # 累積歩数のグラフ
+        fig_cumulative_steps.add_trace(user_trace(user_data, 'cumulative_steps', user_name, color, max_points))
+
+        # 累積距離のグラフ
+        fig_cumulative_distance.add_trace(user_trace(user_data, 'cumulative_distance', user_name, color, max_points))
+
+    # 各グラフのタイトルとレイアウトを設定
+    fig_weight.update_layout(
+        title='体重変動',
+        xaxis_title='Datetime',
+        yaxis_title='Weight [kg]',
+        legend=dict(orientation="h", 
+                    yanchor="bottom", 
+                    y=1.1, 
+                    xanchor="center", 
+                    x=0.5)
+        )
+
+    fig_cumulative_steps.update_layout(
+        title='期間の累計歩数',
+        xaxis_title='Datetime',
+        yaxis_title='Cumulative Steps',
+        legend=dict(orientation="h", 
+                    yanchor="bottom", 
+                    y=1.1, 
+                    xanchor="center", 
+                    x=0.5)
+        )
+
+    fig_steps.update_layout(
+        title='歩数',
+        xaxis_title='Datetime',
+        yaxis_title='Steps',
+        legend=dict(orientation="h", 
+                    yanchor="bottom", 
+                    y=1.1, 
+                    xanchor="center", 
+                    x=0.5)
+        )
+
+    fig_cumulative_distance.update_layout(
+        title='期間の累計移動距離',
+        xaxis_title='Datetime',
+        yaxis_title='Cumulative Distance [km]',
+        legend=dict(orientation="h", 
+                    yanchor="bottom", 
+                    y=1.1, 
+                    xanchor="center", 
+                    x=0.5)
+        )
+
+    fig_distance.update_layout(
+        title='移動距離',
+        xaxis_title='Datetime',
+        yaxis_title='Distance [km]',
+        legend=dict(orientation="h", 
+                    yanchor="bottom", 
+                    y=1.1, 
+                    xanchor="center", 
+                    x=0.5)
+        )
+
+    return fig_weight, fig_cumulative_steps, fig_steps, fig_cumulative_distance, fig_distance
+
+# db: 全グループを取得
+@st.cache_data(ttl=600)
+def get_groups():
+    return [(group.group_id, group.group_name) for group in DatabaseClient().get_all_groups()]
 
 #streamlitページ
 col1, col2= st.columns([1, 5])  # 中央の列を広くする
@@ -174,9 +155,34 @@ with col2:
     # United Athletes Program
     """)
     
+# グループ選択
+groups = get_groups()
+if not groups:
+    st.info('グループが登録されていません。')
+    st.stop()
+group_id, _ = st.selectbox('グループ', groups, format_func=lambda group: group[1])
+
+# 期間と集計単位の選択（初期値は今月・日ごと）
+month_start, month_end = get_current_month_range()
+col_range, col_resolution = st.columns([3, 2])
+with col_range:
+    date_range = st.date_input('期間', value=(month_start.date(), (month_end - timedelta(days=1)).date()))
+with col_resolution:
+    resolution = st.radio('集計単位', RESOLUTIONS, format_func=RESOLUTION_LABELS.get, horizontal=True)
+# 期間を消した場合は今月を表示し、終了日を選ぶまでは開始日の1日だけを表示する
+if len(date_range) == 0:
+    date_range = (month_start.date(), (month_end - timedelta(days=1)).date())
+start_date = date_range[0]
+end_date = date_range[1] if len(date_range) > 1 else start_date
+start = datetime(start_date.year, start_date.month, start_date.day)
+end = datetime(end_date.year, end_date.month, end_date.day) + timedelta(days=1)
+# 月単位の場合は期間を月初から月末までに広げ、月次集計から読めるようにする
+if resolution == 'month':
+    start, end = get_whole_month_range(start, end)
+
+# DBのengineはmodel.dbでプロセス全体に1つだけ作られ、全セッションで共有される
+figures = build_figures(group_id, start, end, resolution, get_data_version(group_id))
+
 # グラフ描画
-st.plotly_chart(fig_weight)
-st.plotly_chart(fig_cumulative_steps)
-st.plotly_chart(fig_steps)
-st.plotly_chart(fig_cumulative_distance)
-st.plotly_chart(fig_distance)
+for fig in figures:
+    st.plotly_chart(fig)
@@ -0,0 +1,72 @@
+import os
+from datetime import datetime, timedelta
+from model.db import DatabaseClient
+from model.google_fit import GoogleFitClient, fit_cache
+from model.ingest import FitIngestor, IngestResult
+from model.metrics import metrics
+
+# 1回のトランザクションで書き込むfit_dataの件数（環境変数で上書き可能）
+BACKFILL_CHUNK_SIZE = int(os.environ.get('UAP_BACKFILL_CHUNK_SIZE', 500))
+
+# 過去days日分（前日まで）のfitデータをGoogle Fitから取り直してtbl_fitに書き込む
+# 取得できた日から順にchunk_size件ずつ書き込み、書き込み終わったユーザ・日をtbl_backfill_checkpointに記録する
+# 途中で止まっても、再実行すると記録済みの日は取得せずに続きから再開する（resume=Falseで最初からやり直す）
+# 全ユーザが最後まで終わったら進捗を削除するので、次の実行はまた最初から取り直す
+# まだ確定していない最近の日は後から値が変わるので進捗に記録せず、再開時も毎回取り直す
+# 確定した日はディスクキャッシュから読むので、最初からやり直してもAPIは最近の日の分しか叩かない
+def main(group_id=1, days=30, max_workers=None, chunk_size=BACKFILL_CHUNK_SIZE, resume=True, db_client=None,
+         client_factory=GoogleFitClient):
+    # db: INSTANCE GENERATION
+    db_client = db_client or DatabaseClient()
+
+    # db: group_idを指定して所属する全てのユーザ情報を取得
+    users = db_client.get_users_by_group(group_id)
+
+    # db: 前回までに書き込み終わったユーザ・日を取得
+    user_ids = [user.user_id for user in users]
+    since = (datetime.now() - timedelta(days=days + 1)).date()
+    checkpoints = {}
+    if resume and users:
+        checkpoints = db_client.get_backfill_checkpoints(user_ids, since)
+
+    # gf: 書き込み終わっていない日だけを古い順に取得するジェネレータ
+    def fetch(gf_client):
+        start_date, _ = gf_client.get_past_dates(days)
+        return gf_client.iter_range_data(start_date, days, skip_days=checkpoints.get(gf_client.user_id, set()))
+
+    # gf: 全ユーザを並列に取得し、取得できた順にchunk_size件ずつ書き込む
+    ingest_result = IngestResult()
+    inserted = updated = 0
+    chunk = []
+    for fit_data in FitIngestor(max_workers, client_factory=client_factory).stream(users, fetch, ingest_result):
+        chunk.append(fit_data)
+        if len(chunk) >= chunk_size:
+            chunk_inserted, chunk_updated = write_chunk(db_client, chunk)
+            inserted += chunk_inserted
+            updated += chunk_updated
+            chunk = []
+    if chunk:
+        chunk_inserted, chunk_updated = write_chunk(db_client, chunk)
+        inserted += chunk_inserted
+        updated += chunk_updated
+    print(f"追加: {inserted}件, 更新: {updated}件")
+
+    # db: 失敗したユーザがいなければ進捗を削除する（失敗した場合は次の実行で続きから再開する）
+    if ingest_result.succeeded() and users:
+        db_client.clear_backfill_checkpoints(user_ids, since)
+    return ingest_result
+
+# db: steps,distanceと進捗を1つのトランザクションで書き込む（ない日は追加する）
+# 進捗はディスクキャッシュと同じく確定した日だけを記録する
+def write_chunk(db_client, chunk):
+    settled_boundary = fit_cache.settled_boundary()
+    with metrics.span('backfill.write_chunk'):
+        with db_client.unit_of_work():
+            counts = db_client.bulk_upsert_fit_data(chunk, update_columns=('steps', 'distance'))
+            db_client.add_backfill_checkpoints([record for record in chunk if record['datetime'] <= settled_boundary])
+    print(f"{len(chunk)}件のfitデータを書き込みました。")
+    return counts
+
+if __name__ == "__main__":
+    with metrics.run('backfill_fit_data'):
+        main()
@@ -0,0 +1,45 @@
+import argparse
+import time
+from model.db import DatabaseClient
+import discord_role_master
+
+# ロール同期Botの起動から、同期に必要なメンバーが揃うまでの時間を測るベンチマーク
+# config/discord.jsonのトークンで実際にログインする（ロールは変更しない）
+#   python -m benchmark.bench_bot_startup --group 1           # 必要なメンバーだけIDで問い合わせる
+#   python -m benchmark.bench_bot_startup --group 1 --chunk   # 従来通りサーバーの全メンバーを読み込む
+
+def main():
+    parser = argparse.ArgumentParser(description='ロール同期Botのコールドスタートの時間を測る')
+    parser.add_argument('--group', type=int, default=1)
+    parser.add_argument('--chunk', action='store_true', help='起動時にサーバーの全メンバーを読み込む')
+    args = parser.parse_args()
+
+    db_client = DatabaseClient()
+    guild_id = db_client.get_discord_guild_id(args.group)
+    user_ids = [user.discord_user_id for user in db_client.get_users_by_group(args.group)]
+
+    bot = discord_role_master.create_bot(chunk_guilds=args.chunk)
+    started = time.perf_counter()
+
+    @bot.event
+    async def on_ready():
+        ready = time.perf_counter() - started
+        guild = bot.get_guild(guild_id)
+        fetch_start = time.perf_counter()
+        if args.chunk:
+            members = {user_id: guild.get_member(user_id) for user_id in user_ids}
+            members = {user_id: member for user_id, member in members.items() if member is not None}
+        else:
+            members = await discord_role_master.fetch_members(guild, user_ids)
+        fetched = time.perf_counter() - fetch_start
+        print(
+            f"{'chunk' if args.chunk else 'targeted'}: guild members {guild.member_count}, "
+            f"group users {len(user_ids)}, found {len(members)}, "
+            f"ready {ready:.2f} s, fetch members {fetched:.2f} s, total {ready + fetched:.2f} s"
+        )
+        await bot.close()
+
+    bot.run(discord_role_master.discord_config.get('token'))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+from sqlalchemy import create_engine, insert
+from sqlalchemy.orm import sessionmaker
+from model.db import Base, Group, User, FitData, DatabaseClient
+import datetime
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# tbl_fitの読み込みをORMとread_fit_columns(列指向)で比較するベンチマーク
+# ローカルのSQLiteに ユーザ数 x 日数 の合成データを作って計測する
+# 使い方: python -m benchmark.bench_fit_columns [ユーザ数] [日数]
+N_USERS = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+N_DAYS = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+
+def create_database(path):
+    engine = create_engine(f'sqlite:///{path}')
+    Base.metadata.create_all(engine)
+    start = datetime.datetime(2020, 1, 1)
+    with engine.begin() as conn:
+        conn.execute(insert(Group), [{'group_id': 1, 'group_name': 'bench', 'discord_guild_id': 0}])
+        conn.execute(insert(User), [
+            {'user_id': user_id, 'user_name': f'user{user_id}', 'group_id': 1, 'discord_user_id': 0, 'steps_coefficient': 1.0}
+            for user_id in range(1, N_USERS + 1)
+        ])
+        for user_id in range(1, N_USERS + 1):
+            conn.execute(insert(FitData), [{
+                'user_id': user_id,
+                'datetime': start + datetime.timedelta(days=day),
+                'steps': random.randint(1000, 30000),
+                'distance': random.uniform(1, 20),
+                'weight': random.uniform(60, 65),
+                'fat': 0.0
+            } for day in range(N_DAYS)])
+    return sessionmaker(bind=engine)
+
+def bench(label, read):
+    # 時間とメモリは別々に計測する（tracemallocを有効にすると処理が遅くなるため）
+    start = time.perf_counter()
+    n_rows = read()
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    read()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{label}: {n_rows} rows, {elapsed:.2f} s, peak {peak / 1024 / 1024:.1f} MiB")
+
+def main():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        print(f"{N_USERS} users x {N_DAYS} days のデータを作成中...")
+        session_factory = create_database(os.path.join(tmpdir, 'bench.db'))
+
+        # before: ORMで全行を読み込み、グラフに使う列を取り出す
+        def read_orm():
+            session = session_factory()
+            try:
+                fit_data = session.query(FitData).all()
+                steps = [item.steps for item in fit_data]
+                return len(steps)
+            finally:
+                session.close()
+        bench('ORM FitData', read_orm)
+
+        # after: 必要な列だけをNumPy配列に読み込む
+        def read_columns():
+            arrays = DatabaseClient(session_factory).read_fit_columns(columns=('user_id', 'datetime', 'steps'))
+            return len(arrays['steps'])
+        bench('read_fit_columns', read_columns)
+
+if __name__ == "__main__":
+    main()
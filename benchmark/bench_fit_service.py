@@ -0,0 +1,28 @@
+from google.oauth2.credentials import Credentials
+from googleapiclient.discovery import build
+from model.google_fit import FitServiceFactory
+import time
+
+# GoogleFitClientのservice生成コストを比較するマイクロベンチマーク
+# ネットワークには接続しない（ダミーのトークンでserviceを作るだけ）
+N_USERS = 200
+
+def bench(label, build_service):
+    creds_list = [Credentials(token=f'dummy-token-{i}') for i in range(N_USERS)]
+    start = time.perf_counter()
+    for creds in creds_list:
+        build_service(creds)
+    elapsed = time.perf_counter() - start
+    print(f"{label}: total {elapsed * 1000:.1f} ms, per user {elapsed / N_USERS * 1000:.3f} ms")
+
+def main():
+    # before: ユーザごとにbuild()でdiscovery documentを読み込み直し、HTTPも作り直す
+    bench('build() per user', lambda creds: build('fitness', 'v1', credentials=creds, static_discovery=True))
+
+    # after: discovery documentは1度だけ読み込み、HTTPは共有して認証情報だけ差し替える
+    factory = FitServiceFactory()
+    factory.get_document()
+    bench('FitServiceFactory', factory.build)
+
+if __name__ == "__main__":
+    main()
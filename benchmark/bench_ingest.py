@@ -0,0 +1,122 @@
+import argparse
+import contextlib
+import io
+import os
+import tempfile
+import time
+from types import SimpleNamespace
+from sqlalchemy import create_engine, func, insert, select
+from sqlalchemy.orm import sessionmaker
+import backfill_fit_data
+import update_fit_data
+from benchmark.fake_fit_api import FakeFitApi
+from model.db import Base, DatabaseClient, FitData, FitMonthly, Group, User
+from model.fit_cache import FitResponseCache
+from model.ingest import FitIngestor
+from model.rate_limit import FitRateLimiter
+
+# 偽のFitness APIを使って、N人 x D日の取り込みのスループットを測るベンチマーク
+# Googleには接続しない（python -m benchmark.bench_ingest --users 100 --days 30）
+# 最後に、毎日の処理(update_fit_data)とbackfillをsqliteに書き込むところまで実行し、
+# tbl_fitへの書き込み・月次集計・data versionの更新を含めた時間を測る
+
+def bench(label, api, run, rate_limiter=None):
+    api.reset_stats()
+    start = time.perf_counter()
+    result = run()
+    elapsed = time.perf_counter() - start
+    stats = api.stats()
+    print(
+        f"{label}: wall {elapsed:.2f} s, requests {stats['requests']} "
+        f"({stats['requests'] / elapsed:.1f} req/s), "
+        f"p50 {stats['p50_ms']:.1f} ms, p99 {stats['p99_ms']:.1f} ms, "
+        f"status {stats['statuses']}, failed users {len(result.errors)}, "
+        f"rows {len(result.fit_data_list)}"
+    )
+    if rate_limiter is not None:
+        print(f"  rate limiter: {rate_limiter.stats()}")
+    return result
+
+# 一時ディレクトリのsqliteにグループ1とusersを作り、そのDBに書き込むDatabaseClientを返す
+def create_sqlite_client(db_dir, users):
+    engine = create_engine(f'sqlite:///{os.path.join(db_dir, "uap.db")}')
+    Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        connection.execute(insert(Group), [{'group_id': 1, 'group_name': 'bench', 'discord_guild_id': 1}])
+        connection.execute(insert(User), [
+            {'user_id': user.user_id, 'user_name': f'user{user.user_id}', 'group_id': 1,
+             'discord_user_id': user.user_id, 'steps_coefficient': user.steps_coefficient}
+            for user in users
+        ])
+    return DatabaseClient(sessionmaker(bind=engine))
+
+def print_db_stats(db_client):
+    session = db_client.session_factory()
+    try:
+        fit_rows = session.scalar(select(func.count()).select_from(FitData))
+        monthly_rows = session.scalar(select(func.count()).select_from(FitMonthly))
+    finally:
+        session.close()
+    print(f"  db: tbl_fit {fit_rows} rows, tbl_fit_monthly {monthly_rows} rows, "
+          f"data version {db_client.get_fit_data_version(1)[0]}")
+
+# 書き込み処理の件数などの表示はベンチマークの結果に混ぜない
+def quietly(run):
+    def quiet_run():
+        with contextlib.redirect_stdout(io.StringIO()):
+            return run()
+    return quiet_run
+
+def main():
+    parser = argparse.ArgumentParser(description='偽のFitness APIで取り込みのスループットを測る')
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--days', type=int, default=30)
+    parser.add_argument('--max-workers', type=int, default=None)
+    parser.add_argument('--latency-ms', type=float, default=50.0, help='1リクエストの平均の待ち時間')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='503を返す割合')
+    parser.add_argument('--user-qps', type=float, default=None, help='ユーザごとの1秒あたりのクォータ')
+    parser.add_argument('--project-qps', type=float, default=None, help='プロジェクト全体の1秒あたりのクォータ')
+    parser.add_argument('--no-rate-limiter', action='store_true', help='制限・リトライなしで実行する')
+    args = parser.parse_args()
+
+    api = FakeFitApi(
+        latency=args.latency_ms / 1000,
+        error_rate=args.error_rate,
+        user_qps=args.user_qps,
+        project_qps=args.project_qps
+    )
+    users = [SimpleNamespace(user_id=user_id, steps_coefficient=1.0) for user_id in range(1, args.users + 1)]
+    print(f"users {args.users}, days {args.days}, latency {args.latency_ms} ms, error rate {args.error_rate}")
+
+    # 制限・リトライ（UAP_FIT_*_QPSなどの環境変数の設定を使う）
+    rate_limiter = None if args.no_rate_limiter else FitRateLimiter()
+
+    # 毎日の処理（前日分）
+    ingestor = FitIngestor(args.max_workers, client_factory=api.client_factory(rate_limiter=rate_limiter))
+    bench('daily', api, lambda: ingestor.run_daily(users), rate_limiter)
+
+    # 過去D日分の取り込み（キャッシュなし）
+    bench(f'past {args.days} days', api, lambda: ingestor.run_past(users, args.days), rate_limiter)
+
+    # 過去D日分の取り込み（確定した日はディスクキャッシュから読む。2回目はキャッシュが効く）
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cached = FitIngestor(args.max_workers, client_factory=api.client_factory(
+            cache=FitResponseCache(cache_dir), rate_limiter=rate_limiter))
+        bench(f'past {args.days} days (cold cache)', api, lambda: cached.run_past(users, args.days), rate_limiter)
+        bench(f'past {args.days} days (warm cache)', api, lambda: cached.run_past(users, args.days), rate_limiter)
+
+    # DBへの書き込みまで含めた毎日の処理とbackfill（一時ディレクトリのsqliteに書き込む）
+    client_factory = api.client_factory(rate_limiter=rate_limiter)
+    with tempfile.TemporaryDirectory() as db_dir:
+        db_client = create_sqlite_client(db_dir, users)
+        # 1回目は全ユーザの初回同期、2回目は変更のない日の同期
+        for label in ('daily job + db (first sync)', 'daily job + db'):
+            bench(label, api, quietly(lambda: update_fit_data.main(
+                1, args.max_workers, db_client=db_client, client_factory=client_factory)), rate_limiter)
+            print_db_stats(db_client)
+        bench(f'backfill {args.days} days + db', api, quietly(lambda: backfill_fit_data.main(
+            1, args.days, args.max_workers, db_client=db_client, client_factory=client_factory)), rate_limiter)
+        print_db_stats(db_client)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+import json
+import random
+import threading
+import time
+import zlib
+from urllib.parse import urlparse, parse_qs, unquote
+import httplib2
+from google.oauth2.credentials import Credentials
+from model.google_fit import GoogleFitClient, FitServiceFactory, NANOS_PER_DAY
+from model.rate_limit import TokenBucket
+
+NANOS_PER_HOUR = NANOS_PER_DAY // 24
+# UTCからJSTへのずれ（JSTの0時はUTCの前日15時）
+JST_OFFSET_NANOS = 9 * NANOS_PER_HOUR
+# pointが終わってからスマホから同期されるまでの時間
+SYNC_DELAY_MILLIS = 10 * 60 * 1000
+# dataPointChangesで返す変更の日数
+CHANGE_FEED_DAYS = 30
+
+class FakeFitApi:
+    """
+    Fitness APIのdatasets.getとdataPointChanges.listを真似るローカルの偽のAPI
+    FitServiceFactory(http_factory=api.http)に渡すと、httplib2の代わりに応答を返す
+    データはユーザ・data source・時刻から決まる合成データで、何度取得しても同じ値になる
+      latency: 1リクエストの平均の待ち時間(秒)。対数正規分布でばらつかせる
+      error_rate: 503を返す割合
+      user_qps / project_qps: ユーザごと・プロジェクト全体の1秒あたりのクォータ。超えると429を返す
+      page_size: 1ページに含めるpoint数の上限
+    """
+    def __init__(self, latency=0.05, error_rate=0.0, user_qps=None, project_qps=None, page_size=1000, seed=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.user_qps = user_qps
+        self.project_qps = project_qps
+        self.page_size = page_size
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._project_bucket = TokenBucket(project_qps) if project_qps else None
+        self._user_buckets = {}
+        self._late_points = {}  # (user_id, data source) -> 遅れて届いたpoint
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self._lock:
+            self.latencies = []
+            self.statuses = {}
+
+    # FitServiceFactoryのhttp_factoryとして渡す
+    def http(self):
+        return FakeFitHttp(self)
+
+    # FitIngestorのclient_factoryとして渡す（トークンファイルは読まない）
+    def client_factory(self, archive=None, cache=None, rate_limiter=None):
+        service_factory = FitServiceFactory(http_factory=self.http)
+        def create(user_id):
+            return FakeFitClient(user_id, service_factory=service_factory, archive=archive, cache=cache,
+                                 rate_limiter=rate_limiter)
+        return create
+
+    def add_late_point(self, user_id, data_source, start_nanos, end_nanos, value):
+        """スマホの同期が遅れて届いたpointを追加する（modifiedTimeMillisは追加した時刻）"""
+        point = self.point(data_source, start_nanos, end_nanos, value, int(time.time() * 1000))
+        with self._lock:
+            self._late_points.setdefault((str(user_id), data_source), []).append(point)
+
+    def handle(self, uri, headers):
+        parsed = urlparse(uri)
+        parts = parsed.path.split('/')
+        data_source = unquote(parts[parts.index('dataSources') + 1])
+        query = parse_qs(parsed.query)
+        page_token = query.get('pageToken', ['0'])[0]
+        user_id = self.user_of(headers)
+
+        with self._lock:
+            delay = self._random.lognormvariate(0, 0.5) * self.latency if self.latency else 0.0
+            failed = self._random.random() < self.error_rate
+            throttled = not self.take_quota(user_id)
+        time.sleep(delay)
+
+        if throttled:
+            return 429, {'error': {'code': 429, 'message': 'Quota exceeded', 'status': 'RESOURCE_EXHAUSTED'}}
+        if failed:
+            return 503, {'error': {'code': 503, 'message': 'Backend Error', 'status': 'UNAVAILABLE'}}
+
+        offset = int(page_token)
+        if 'dataPointChanges' in parts:
+            return 200, self.changes(user_id, data_source, offset, int(query.get('limit', [self.page_size])[0]))
+
+        start_nanos, end_nanos = map(int, unquote(parts[parts.index('datasets') + 1]).split('-'))
+        points = self.points(user_id, data_source, start_nanos, end_nanos)
+        dataset = {
+            'minStartTimeNs': str(start_nanos),
+            'maxEndTimeNs': str(end_nanos),
+            'dataSourceId': data_source,
+            'point': points[offset:offset + self.page_size]
+        }
+        if offset + self.page_size < len(points):
+            dataset['nextPageToken'] = str(offset + self.page_size)
+        return 200, dataset
+
+    @staticmethod
+    def user_of(headers):
+        for name, value in (headers or {}).items():
+            if name.lower() == 'authorization':
+                return value.rsplit('-', 1)[-1]
+        return 'anonymous'
+
+    def take_quota(self, user_id):
+        if self._project_bucket is not None and self._project_bucket.try_acquire() is not None:
+            return False
+        if self.user_qps:
+            bucket = self._user_buckets.setdefault(user_id, TokenBucket(self.user_qps))
+            if bucket.try_acquire() is not None:
+                return False
+        return True
+
+    def points(self, user_id, data_source, start_nanos, end_nanos):
+        key = GoogleFitClient.DATA_SOURCE_KEYS[data_source]
+        points = []
+        if key in ("steps", "distance"):
+            # JSTの7時から22時まで1時間ごとのpoint（hourはJSTの時刻で数える）
+            hour = (start_nanos + JST_OFFSET_NANOS) // NANOS_PER_HOUR
+            while hour * NANOS_PER_HOUR - JST_OFFSET_NANOS < end_nanos:
+                point_start = hour * NANOS_PER_HOUR - JST_OFFSET_NANOS
+                if 7 <= hour % 24 < 22 and point_start + NANOS_PER_HOUR > start_nanos:
+                    seed = self.seed_of(user_id, key, hour)
+                    steps = seed % 1500
+                    value = {'intVal': steps} if key == "steps" else {'fpVal': steps * 0.7}
+                    points.append(self.point(data_source, point_start, point_start + NANOS_PER_HOUR, value))
+                hour += 1
+        else:
+            # 体重・体脂肪率は毎朝7時(JST)に1回だけ記録する（dayはJSTの日付で数える）
+            day = (start_nanos + JST_OFFSET_NANOS) // NANOS_PER_DAY
+            while day * NANOS_PER_DAY - JST_OFFSET_NANOS < end_nanos:
+                point_time = day * NANOS_PER_DAY - JST_OFFSET_NANOS + 7 * NANOS_PER_HOUR
+                if start_nanos <= point_time < end_nanos:
+                    seed = self.seed_of(user_id, key, day)
+                    value = 60 + seed % 200 / 10 if key == "weights" else 15 + seed % 100 / 10
+                    points.append(self.point(data_source, point_time, point_time, {'fpVal': value}))
+                day += 1
+        with self._lock:
+            late_points = list(self._late_points.get((user_id, data_source), []))
+        points += [point for point in late_points if GoogleFitClient.point_in_day(point, start_nanos, end_nanos)]
+        return sorted(points, key=lambda point: int(point['startTimeNanos']))
+
+    def changes(self, user_id, data_source, offset, limit):
+        """直近CHANGE_FEED_DAYS日のpointを、変更された時刻の新しい順に返す"""
+        now_nanos = time.time_ns()
+        points = self.points(user_id, data_source, now_nanos - CHANGE_FEED_DAYS * NANOS_PER_DAY, now_nanos)
+        points = [point for point in points if int(point['modifiedTimeMillis']) <= now_nanos // 10**6]
+        points.sort(key=lambda point: int(point['modifiedTimeMillis']), reverse=True)
+        response = {'dataSourceId': data_source, 'insertedDataPoint': points[offset:offset + limit]}
+        if offset + limit < len(points):
+            response['nextPageToken'] = str(offset + limit)
+        return response
+
+    @staticmethod
+    def seed_of(user_id, key, index):
+        return zlib.crc32(f'{user_id}:{key}:{index}'.encode('utf-8'))
+
+    @staticmethod
+    def point(data_source, start_nanos, end_nanos, value, modified_millis=None):
+        # 遅れて届いたpoint以外は、終わってからSYNC_DELAY_MILLIS後にスマホから同期されたことにする
+        if modified_millis is None:
+            modified_millis = end_nanos // 10**6 + SYNC_DELAY_MILLIS
+        return {
+            'startTimeNanos': str(start_nanos),
+            'endTimeNanos': str(end_nanos),
+            'dataTypeName': data_source.split(':')[1],
+            'originDataSourceId': data_source,
+            'modifiedTimeMillis': str(modified_millis),
+            'value': [value]
+        }
+
+    def record(self, status, elapsed):
+        with self._lock:
+            self.latencies.append(elapsed)
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+
+    def stats(self):
+        with self._lock:
+            latencies = sorted(self.latencies)
+            statuses = dict(self.statuses)
+        def percentile(p):
+            if not latencies:
+                return 0.0
+            return latencies[min(len(latencies) - 1, int(len(latencies) * p))]
+        return {
+            'requests': len(latencies),
+            'statuses': statuses,
+            'p50_ms': percentile(0.50) * 1000,
+            'p99_ms': percentile(0.99) * 1000
+        }
+
+class FakeFitHttp:
+    """httplib2.Httpの代わりにFakeFitApiへ問い合わせる"""
+    def __init__(self, api):
+        self.api = api
+
+    def request(self, uri, method='GET', body=None, headers=None, redirections=None, connection_type=None, **kwargs):
+        start = time.perf_counter()
+        status, content = self.api.handle(uri, headers)
+        self.api.record(status, time.perf_counter() - start)
+        response = httplib2.Response({'status': status, 'content-type': 'application/json; charset=UTF-8'})
+        return response, json.dumps(content).encode('utf-8')
+
+class FakeFitClient(GoogleFitClient):
+    """トークンファイルの代わりにダミーのトークンを使うGoogleFitClient"""
+    def get_credentials(self):
+        return Credentials(token=f'fake-token-{self.user_id}')
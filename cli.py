@@ -0,0 +1,126 @@
+import argparse
+import importlib
+import os
+import subprocess
+import sys
+import time
+
+# 毎日の処理をまとめたコマンド
+#   python cli.py ingest --group 1 [--incremental]
+#   python cli.py backfill --group 1 --days 365 [--chunk-size 500] [--no-resume]
+#   python cli.py reaggregate --group 1 --start 2024-11-01 --end 2024-12-01 [--insert-missing]
+#   python cli.py judge --group 1
+#   python cli.py sync-roles --group 1 --group 2
+#   python cli.py seed
+# 各コマンドは必要なモジュールだけを実行時に読み込む（cronの短い処理が他のコマンドの依存を読み込まない）
+# --importtimeを付けると python -X importtime で実行し、読み込みに時間のかかったモジュールを表示する
+
+IMPORTTIME_TOP = 15
+
+def load(module_name):
+    """コマンドのモジュールを読み込み、かかった時間と読み込んだモジュール数を表示する"""
+    modules_before = len(sys.modules)
+    start = time.perf_counter()
+    module = importlib.import_module(module_name)
+    elapsed = time.perf_counter() - start
+    print(f"[startup] {module_name}: import {elapsed * 1000:.1f} ms, {len(sys.modules) - modules_before} modules", file=sys.stderr)
+    return module
+
+def ingest(args):
+    if args.incremental:
+        # 前回の同期以降に変化のあった日だけを取得する
+        result = load('update_fit_data').main(args.group, args.max_workers)
+    else:
+        # 前日のデータを取得する
+        result = load('uap').main(args.group, args.max_workers)
+    print(f"失敗したユーザ {list(result.errors)}")
+
+def backfill(args):
+    backfill_fit_data = load('backfill_fit_data')
+    result = backfill_fit_data.main(args.group, args.days, args.max_workers,
+                                    args.chunk_size or backfill_fit_data.BACKFILL_CHUNK_SIZE, not args.no_resume)
+    print(f"失敗したユーザ {list(result.errors)}")
+
+def reaggregate(args):
+    load('reaggregate_fit').main(args.group, args.start, args.end, args.insert_missing)
+
+def judge(args):
+    load('judge_role').main(args.group)
+
+def sync_roles(args):
+    load('discord_role_master').main(args.group or [1])
+
+def seed(args):
+    # db/はパッケージではないのでパスを通して読み込む
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'db'))
+    load('test_db_init').main()
+
+def run_with_importtime(argv):
+    """自分自身を -X importtime で実行し直し、累積の読み込み時間が長いモジュールを表示する"""
+    process = subprocess.run(
+        [sys.executable, '-X', 'importtime', os.path.abspath(__file__), *argv],
+        stderr=subprocess.PIPE, text=True
+    )
+    imports = []
+    for line in process.stderr.splitlines():
+        if not line.startswith('import time:'):
+            print(line, file=sys.stderr)
+            continue
+        fields = line[len('import time:'):].split('|')
+        if fields[0].strip().isdigit():
+            imports.append((int(fields[1]), fields[2].strip()))
+    imports.sort(reverse=True)
+    print(f"[importtime] top {IMPORTTIME_TOP} (cumulative ms)", file=sys.stderr)
+    for cumulative, module_name in imports[:IMPORTTIME_TOP]:
+        print(f"  {cumulative / 1000:9.1f}  {module_name}", file=sys.stderr)
+    return process.returncode
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    parser = argparse.ArgumentParser(description='UAPの毎日の処理')
+    parser.add_argument('--importtime', action='store_true', help='モジュールの読み込み時間を表示する')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    parser_ingest = subparsers.add_parser('ingest', help='Google Fitからfitデータを取り込む')
+    parser_ingest.add_argument('--group', type=int, default=1)
+    parser_ingest.add_argument('--incremental', action='store_true', help='前回の同期以降に変化のあった日だけを取り込む')
+    parser_ingest.add_argument('--max-workers', type=int, default=None)
+    parser_ingest.set_defaults(func=ingest)
+
+    parser_backfill = subparsers.add_parser('backfill', help='過去の期間のfitデータを取り直す')
+    parser_backfill.add_argument('--group', type=int, default=1)
+    parser_backfill.add_argument('--days', type=int, default=30)
+    parser_backfill.add_argument('--max-workers', type=int, default=None)
+    parser_backfill.add_argument('--chunk-size', type=int, default=None, help='1回のトランザクションで書き込む件数')
+    parser_backfill.add_argument('--no-resume', action='store_true', help='前回の進捗を使わずに最初からやり直す')
+    parser_backfill.set_defaults(func=backfill)
+
+    parser_reaggregate = subparsers.add_parser('reaggregate', help='アーカイブからtbl_fitを作り直す（APIには接続しない）')
+    parser_reaggregate.add_argument('--group', type=int, default=1)
+    parser_reaggregate.add_argument('--start', required=True, help='開始日(JST, YYYY-MM-DD)')
+    parser_reaggregate.add_argument('--end', required=True, help='終了日(JST, YYYY-MM-DD, この日は含まない)')
+    parser_reaggregate.add_argument('--insert-missing', action='store_true', help='tbl_fitにない日も追加する')
+    parser_reaggregate.set_defaults(func=reaggregate)
+
+    parser_judge = subparsers.add_parser('judge', help='今月の集計からロールを判定する')
+    parser_judge.add_argument('--group', type=int, default=1)
+    parser_judge.set_defaults(func=judge)
+
+    parser_sync_roles = subparsers.add_parser('sync-roles', help='Discordのロールを同期する')
+    parser_sync_roles.add_argument('--group', type=int, action='append', help='複数指定できる（省略時は1）')
+    parser_sync_roles.set_defaults(func=sync_roles)
+
+    parser_seed = subparsers.add_parser('seed', help='開発用にダミーのfitデータを入れる')
+    parser_seed.set_defaults(func=seed)
+
+    args = parser.parse_args(argv)
+    if args.importtime:
+        return run_with_importtime([arg for arg in argv if arg != '--importtime'])
+
+    from model.metrics import metrics
+    with metrics.run(args.command):
+        args.func(args)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
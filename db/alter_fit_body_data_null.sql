@@ -0,0 +1,4 @@
+-- weight,fatが未計測(0)の行をNULLにする
+-- backfill等で追加した0の行が、直近の体重として引き継がれないようにする
+UPDATE tbl_fit SET weight = NULL WHERE weight = 0;
+UPDATE tbl_fit SET fat = NULL WHERE fat = 0;
@@ -0,0 +1,31 @@
+-- tbl_fit_monthlyに累計と体重・体脂肪率の平均を追加し、ダッシュボードの月単位の表示に使えるようにする
+ALTER TABLE tbl_fit_monthly
+ADD COLUMN running_steps BIGINT NOT NULL DEFAULT 0 AFTER total_distance,
+ADD COLUMN running_distance FLOAT NOT NULL DEFAULT 0 AFTER running_steps,
+ADD COLUMN avg_weight FLOAT AFTER running_distance,
+ADD COLUMN avg_fat FLOAT AFTER avg_weight;
+
+-- 既存の行の累計を計算する
+UPDATE tbl_fit_monthly m
+JOIN (
+    SELECT
+        user_id,
+        month,
+        SUM(total_steps) OVER (PARTITION BY user_id ORDER BY month) AS running_steps,
+        SUM(total_distance) OVER (PARTITION BY user_id ORDER BY month) AS running_distance
+    FROM tbl_fit_monthly
+) r ON r.user_id = m.user_id AND r.month = m.month
+SET m.running_steps = r.running_steps, m.running_distance = r.running_distance;
+
+-- 既存の行の体重・体脂肪率の平均を計算する
+UPDATE tbl_fit_monthly m
+JOIN (
+    SELECT
+        user_id,
+        DATE_FORMAT(datetime, '%Y-%m-01') AS month,
+        AVG(NULLIF(weight, 0)) AS avg_weight,
+        AVG(NULLIF(fat, 0)) AS avg_fat
+    FROM tbl_fit
+    GROUP BY user_id, DATE_FORMAT(datetime, '%Y-%m-01')
+) a ON a.user_id = m.user_id AND a.month = m.month
+SET m.avg_weight = a.avg_weight, m.avg_fat = a.avg_fat;
@@ -0,0 +1,5 @@
+-- tbl_sync_watermarkをpointの終了時刻(last_end_nanos)から変更時刻(last_modified_millis)に切り替える
+-- 単位が違うので既存のwatermarkは削除し、次回の同期で各ユーザを初回同期し直す
+DELETE FROM tbl_sync_watermark;
+ALTER TABLE tbl_sync_watermark
+CHANGE last_end_nanos last_modified_millis BIGINT NOT NULL;
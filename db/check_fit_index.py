@@ -0,0 +1,35 @@
+from sqlalchemy import text
+from model.db import Session, FitData, fit_data_between, get_current_month_range
+import sys
+
+# tbl_fitの日付範囲検索でidx_user_datetime(user_id, datetime)が使われているかを本番のMySQLのEXPLAINで確認するスクリプト
+# DBなしで繰り返し確認できるSQLite版は tests/test_fit_date_range.py
+# 範囲検索に使える複合インデックス（UNIQUE (user_id, datetime) を含む）
+COMPOSITE_INDEXES = ('idx_user_datetime', 'user_id')
+
+def explain(session, query):
+    sql = str(query.statement.compile(bind=session.get_bind(), compile_kwargs={"literal_binds": True}))
+    return session.execute(text(f'EXPLAIN {sql}')).mappings().all()
+
+def main():
+    session = Session()
+    try:
+        # 件数の一番多いユーザで確認する
+        user_id = session.query(FitData.user_id).group_by(FitData.user_id).order_by(text('COUNT(*) DESC')).limit(1).scalar()
+        start, end = get_current_month_range()
+        query = session.query(FitData).filter(fit_data_between(user_id, start, end))
+
+        ok = True
+        for row in explain(session, query):
+            print(dict(row))
+            if row['key'] not in COMPOSITE_INDEXES or row['type'] != 'range':
+                ok = False
+        if not ok:
+            print("NG: tbl_fitの日付範囲検索で複合インデックスの範囲スキャンが使われていません。")
+            sys.exit(1)
+        print("OK: tbl_fitの日付範囲検索で複合インデックスの範囲スキャンが使われています。")
+    finally:
+        session.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,10 @@
+-- テーブル: tbl_backfill_checkpoint
+-- backfillでtbl_fitに書き込み終わったユーザ・日（JST）を保持する
+-- fitデータと同じトランザクションで書き込むので、途中で止まっても書き込み終わった日から再開できる
+CREATE TABLE tbl_backfill_checkpoint (
+    user_id INT NOT NULL,
+    day DATE NOT NULL,
+    updated_at DATETIME NOT NULL,
+    PRIMARY KEY (user_id, day),
+    FOREIGN KEY (user_id) REFERENCES tbl_user(user_id)
+);
@@ -0,0 +1,8 @@
+-- テーブル: tbl_data_version
+-- tbl_fitを書き込むたびに、書き込んだユーザのグループのversionを増やす。ダッシュボードのキャッシュの無効化に使う
+-- nameは 'tbl_fit:group={group_id}'。行は最初に書き込んだ時にupsertで作られる
+CREATE TABLE tbl_data_version (
+    name VARCHAR(255) NOT NULL PRIMARY KEY,
+    version BIGINT NOT NULL,
+    updated_at DATETIME NOT NULL
+);
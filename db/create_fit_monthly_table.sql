@@ -0,0 +1,53 @@
+-- テーブル: tbl_fit_monthly
+-- ユーザごとの月次集計。tbl_fitを書き込むたびに、書き込んだ月だけを集計し直し、その月以降の累計を計算し直す
+-- ダッシュボードの月単位の表示とロール判定に使う
+CREATE TABLE tbl_fit_monthly (
+    user_id INT NOT NULL,
+    month DATE NOT NULL,
+    days INT NOT NULL,
+    total_steps BIGINT NOT NULL,
+    total_distance FLOAT NOT NULL,
+    running_steps BIGINT NOT NULL DEFAULT 0,
+    running_distance FLOAT NOT NULL DEFAULT 0,
+    avg_weight FLOAT,
+    avg_fat FLOAT,
+    max_steps INT,
+    min_steps INT,
+    days_over_10000 INT NOT NULL,
+    updated_at DATETIME NOT NULL,
+    PRIMARY KEY (user_id, month),
+    FOREIGN KEY (user_id) REFERENCES tbl_user(user_id)
+);
+
+-- 既存のtbl_fitから集計を作成する
+INSERT INTO tbl_fit_monthly (user_id, month, days, total_steps, total_distance, running_steps, running_distance,
+                             avg_weight, avg_fat, max_steps, min_steps, days_over_10000, updated_at)
+SELECT
+    user_id,
+    month,
+    days,
+    total_steps,
+    total_distance,
+    SUM(total_steps) OVER (PARTITION BY user_id ORDER BY month),
+    SUM(total_distance) OVER (PARTITION BY user_id ORDER BY month),
+    avg_weight,
+    avg_fat,
+    max_steps,
+    min_steps,
+    days_over_10000,
+    NOW()
+FROM (
+    SELECT
+        user_id,
+        DATE_FORMAT(datetime, '%Y-%m-01') AS month,
+        COUNT(id) AS days,
+        COALESCE(SUM(steps), 0) AS total_steps,
+        COALESCE(SUM(distance), 0) AS total_distance,
+        AVG(NULLIF(weight, 0)) AS avg_weight,
+        AVG(NULLIF(fat, 0)) AS avg_fat,
+        MAX(steps) AS max_steps,
+        MIN(steps) AS min_steps,
+        SUM(CASE WHEN steps > 10000 THEN 1 ELSE 0 END) AS days_over_10000
+    FROM tbl_fit
+    GROUP BY user_id, DATE_FORMAT(datetime, '%Y-%m-01')
+) monthly;
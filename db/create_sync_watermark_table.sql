@@ -0,0 +1,10 @@
+-- テーブル: tbl_sync_watermark
+-- ユーザ・data sourceごとに、Google FitのdataPointChangesで最後に取得した変更のmodifiedTimeMillisを保持する
+CREATE TABLE tbl_sync_watermark (
+    user_id INT NOT NULL,
+    data_source VARCHAR(255) NOT NULL,
+    last_modified_millis BIGINT NOT NULL,
+    updated_at DATETIME NOT NULL,
+    PRIMARY KEY (user_id, data_source),
+    FOREIGN KEY (user_id) REFERENCES tbl_user(user_id)
+);
@@ -19,12 +19,14 @@ def main():
     # 1日
     dt = datetime.datetime(now_utc.year, now_utc.month, 1, tzinfo=datetime.UTC)
     
+    fit_data_list = []
     for day in range(1, now_utc.day):
         # gf: 各ユーザのfit_dataを取得してリスト化
-        fit_data_list = []
         for user_id in user_ids:
             gf_data = mock_get_fit_data(user_id)
+            gf_data['datetime'] = dt
             fit_data_list.append(gf_data)
+            print(gf_data)
             
         # # db: weight,fatが未更新の場合は直近のデータを引き継ぎ
         # for fit_data in fit_data_list:
@@ -33,13 +35,11 @@ def main():
         #         fit_data['weight'] = latest_fit_data.weight
         #         fit_data['body_fat_percentage'] = latest_fit_data.fat
         
-        # db: fit_date_listをdbへ書き込む
-        for fit_data in fit_data_list:
-            db_client.add_fit_data(fit_data, datetime=dt)
-            print(fit_data)
-            print(dt)
-        
         dt += datetime.timedelta(days=1)
+    
+    # db: fit_date_listをまとめてdbへ書き込む
+    inserted, updated = db_client.bulk_upsert_fit_data(fit_data_list)
+    print(f"追加: {inserted}件, 更新: {updated}件")
 
 def mock_get_fit_data(user_id):
     results = {
@@ -1,9 +1,12 @@
 
 import json
+import time
+import asyncio
 import discord
 from discord.ext import commands
 from model.db import DatabaseClient
-from model.discord_webhook import DiscordWebhook
+from model.discord_webhook import AsyncDiscordWebhook, WebhookBatcher
+from model.metrics import metrics
 
 # dicordのコンフィグファイルを読み込む
 with open('config/discord.json', 'r') as f:
@@ -12,101 +15,161 @@ with open('config/discord.json', 'r') as f:
 # 削除しない固定ロールを読み込む
 static_role_ids = discord_config.get('static_role_ids')
 
-# discord_webhook: INSTANCE GENERATION
-discord_webhook = DiscordWebhook(discord_config.get('webhook_url'))
+# discord_webhook: ロールの変更をまとめて通知するWebhookのURL
+webhook_url = discord_config.get('webhook_url')
 
-# db: INSTANCE GENERATION
-db_client = DatabaseClient()
+# 同時にロールを更新するメンバー数の上限
+# discord.pyはレート制限のバケットごとに待ち合わせるので、同時実行数を絞ってまとめて待たないようにする
+MAX_CONCURRENT_EDITS = 5
 
-# db: tbl_groupからgroup_idを指定してdiscord_guild_idを取得
-discord_guild_id = db_client.get_discord_guild_id(1)
+# 1回のメンバー要求で問い合わせるユーザ数（Discordの上限は100）
+MEMBER_QUERY_BATCH = 100
 
 # db: group_idを指定して所属する全てのユーザの"discord_user_id"とdiscord_rolesを取得
-# ユーザー情報を取得
-users = db_client.get_users_by_group(1)
+def get_user_roles_dict(db_client, group_id):
+    # ユーザー情報を取得
+    users = db_client.get_users_by_group(group_id)
 
-# 辞書を作成してユーザー情報を格納
-user_roles_dict = {}
-for user in users:
-    user_roles_dict[user.discord_user_id] = user.discord_roles
+    # 辞書を作成してユーザー情報を格納
+    user_roles_dict = {}
+    for user in users:
+        user_roles_dict[user.discord_user_id] = user.discord_roles
 
-# 結果を表示（デバッグ用）
-for discord_user_id, discord_roles in user_roles_dict.items():
-    print(f"User ID: {discord_user_id}, Roles: {discord_roles}")
-
-# Botのインスタンスを作成
-intents = discord.Intents.default()
-intents.members = True  # メンバー関連のイベントを受け取るために必要
-intents.message_content = True  # メッセージコンテンツのIntentを有効にする
-
-bot = commands.Bot(command_prefix='!', intents=intents)
-
-# Botが起動したときのイベントハンドラ
-@bot.event
-async def on_ready():
-    print(f'Logged in as {bot.user.name}')
-    await assign_roles_to_all_users()
-    await bot.close()  # ロール付与の処理が完了した後にBotを終了
-
-# 全ユーザーにロールを付与する関数
-async def assign_roles_to_all_users():
+    # 結果を表示（デバッグ用）
     for discord_user_id, discord_roles in user_roles_dict.items():
-        await remove_all_roles(discord_guild_id, discord_user_id)
-        await assign_roles_on_startup(discord_guild_id, discord_user_id, discord_roles)
-        
-# ユーザーのすべてのロールを外す関数
-async def remove_all_roles(guild_id, user_id):
+        print(f"User ID: {discord_user_id}, Roles: {discord_roles}")
+    return user_roles_dict
+
+# 全ユーザーのロールを同期する関数
+async def assign_roles_to_all_users(bot, guild_id, user_roles_dict, semaphore, notifier=None):
     guild = bot.get_guild(guild_id)
     if guild is None:
         print(f"サーバーID {guild_id} が見つかりません。")
         return
 
-    member = guild.get_member(user_id)
+    members = await fetch_members(guild, list(user_roles_dict))
+    await asyncio.gather(*(
+        sync_member_roles(guild, members, discord_user_id, discord_roles, semaphore, notifier)
+        for discord_user_id, discord_roles in user_roles_dict.items()
+    ))
+
+# サーバーの全メンバーは読み込まず、DBにいるユーザだけをIDでまとめて問い合わせる
+async def fetch_members(guild, user_ids):
+    members = {}
+    with metrics.span('discord.fetch_members'):
+        for i in range(0, len(user_ids), MEMBER_QUERY_BATCH):
+            batch = user_ids[i:i + MEMBER_QUERY_BATCH]
+            for member in await guild.query_members(user_ids=batch, limit=len(batch), cache=False):
+                members[member.id] = member
+    return members
+
+# メンバーの目標のロールを求める関数
+def get_target_roles(guild, member, role_ids):
+    # 固定ロール・Botが管理できないロールは現在の状態のまま残す
+    target_roles = {
+        role for role in member.roles
+        if not role.is_default() and (role.id in static_role_ids or role.managed or role >= guild.me.top_role)
+    }
+    for role_id in role_ids:
+        role = guild.get_role(int(role_id)) # DBから取得したrole_idはstr型なのでint型に変換
+        if role is None:
+            print(f"ロールID {role_id} が見つかりません。")
+            continue
+        target_roles.add(role)
+    return target_roles
+
+# ユーザーのロールを差分だけ1回のAPI呼び出しで更新する関数
+async def sync_member_roles(guild, members, user_id, role_ids, semaphore, notifier=None):
+    member = members.get(user_id)
     if member is None:
         print(f"ユーザーID {user_id} が見つかりません。")
         return
 
-    # ユーザーのすべてのロールを外す
-    current_roles = member.roles
-    for role in current_roles:
-        if role.name != "@everyone" and role.id not in static_role_ids:  # @everyoneロールと特定のロールは外さない
-            try:
-                await member.remove_roles(role)
-                print(f'{member.name} から {role.name} ロールを外しました。')
-            except Exception as e:
-                print(f'{role.name} ロールの削除に失敗しました: {e}')
-
-# ユーザーにロールを付与する関数
-async def assign_roles_on_startup(guild_id, user_id, role_ids):
-    guild = bot.get_guild(guild_id)
-    if guild is None:
-        print(f"サーバーID {guild_id} が見つかりません。")
+    if role_ids is None:
+        print(f"{member.name} のロールが判定されていません。")
         return
+    role_ids = json.loads(role_ids) # JSON形式の文字列をリストに変換
 
-    member = guild.get_member(user_id)
-    if member is None:
-        print(f"ユーザーID {user_id} が見つかりません。")
+    current_roles = {role for role in member.roles if not role.is_default()}
+    target_roles = get_target_roles(guild, member, role_ids)
+    if current_roles == target_roles:
+        print(f'{member.name} のロールに変更はありません。')
         return
 
-    # role_idsに記載のロールを付与
-    role_ids = json.loads(role_ids) # JSON形式の文字列をリストに変換
-    for role_id in role_ids:
-        role = guild.get_role(int(role_id)) # DBから取得したrole_idはstr型なのでint型に変換
-        if role is None:
-            print(f"ロールID {role_id} が見つかりません。")
-            continue
-
+    async with semaphore:
         try:
-            await member.add_roles(role)
-            print(f'{member.name} に {role.name} ロールを付与しました。')
-            
+            with metrics.span('discord.member_edit'):
+                await member.edit(roles=list(target_roles))
+            for role in target_roles - current_roles:
+                print(f'{member.name} に {role.name} ロールを付与しました。')
+            for role in current_roles - target_roles:
+                print(f'{member.name} から {role.name} ロールを外しました。')
+            if notifier is not None:
+                added = ', '.join(role.name for role in target_roles - current_roles) or 'なし'
+                removed = ', '.join(role.name for role in current_roles - target_roles) or 'なし'
+                notifier.add(f'{member.mention}: 付与 {added} / 削除 {removed}')
         except Exception as e:
-            print(f'ロールの付与に失敗しました: {e}')
+            print(f'{member.name} のロールの更新に失敗しました: {e}')
+
+# Botのインスタンスを作成
+# chunk_guilds=Falseの場合は起動時にサーバーの全メンバーを読み込まない（必要なメンバーはfetch_membersで取得する）
+def create_bot(chunk_guilds=False):
+    intents = discord.Intents.default()
+    intents.members = True  # IDでメンバーを問い合わせるために必要
+    intents.message_content = True  # メッセージコンテンツのIntentを有効にする
+
+    return commands.Bot(
+        command_prefix='!',
+        intents=intents,
+        chunk_guilds_at_startup=chunk_guilds,
+        member_cache_flags=discord.MemberCacheFlags.from_intents(intents) if chunk_guilds else discord.MemberCacheFlags.none()
+    )
+
+# 複数のグループのロールを1回のBotのログインでまとめて同期する
+def main(group_ids=(1,)):
+    # db: INSTANCE GENERATION
+    db_client = DatabaseClient()
+
+    # db: tbl_groupからgroup_idを指定してdiscord_guild_idを取得
+    # 同じサーバーを使うグループのユーザはまとめて同期する
+    guild_user_roles = {}
+    for group_id in group_ids:
+        discord_guild_id = db_client.get_discord_guild_id(group_id)
+        guild_user_roles.setdefault(discord_guild_id, {}).update(get_user_roles_dict(db_client, group_id))
+
+    bot = create_bot()
+    started = time.perf_counter()
+
+    # Botが起動したときのイベントハンドラ
+    @bot.event
+    async def on_ready():
+        print(f'Logged in as {bot.user.name}')
+        # ログインしてからon_readyまでの時間
+        metrics.observe('discord.ready', time.perf_counter() - started)
+        # サーバーごとに並列に同期し、1つのサーバーの失敗は他のサーバーに影響させない
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_EDITS)
+        # ユーザごとの変更は1件ずつ送らず、最後にまとめて通知する
+        notifier = WebhookBatcher('UAPロールが更新されました') if webhook_url else None
+        results = await asyncio.gather(*(
+            assign_roles_to_all_users(bot, guild_id, user_roles_dict, semaphore, notifier)
+            for guild_id, user_roles_dict in guild_user_roles.items()
+        ), return_exceptions=True)
+        for guild_id, result in zip(guild_user_roles, results):
+            if isinstance(result, Exception):
+                print(f"サーバーID {guild_id} のロールの同期に失敗しました: {result}")
+        if notifier is not None and notifier.lines:
+            try:
+                async with AsyncDiscordWebhook(webhook_url) as webhook:
+                    await notifier.flush(webhook)
+            except Exception as e:
+                print(f"ロールの更新の通知に失敗しました: {e}")
+        await bot.close()  # ロール付与の処理が完了した後にBotを終了
 
-# Botのトークンを使って実行
-token = discord_config.get('token')
-print(token)
-bot.run(token)
+    # Botのトークンを使って実行
+    token = discord_config.get('token')
+    print(token)
+    bot.run(token)
 
-# メッセージを送信
-# discord_webhook.send_message("UAPロールが付与されました。")
\ No newline at end of file
+if __name__ == "__main__":
+    with metrics.run('discord_role_master'):
+        main()
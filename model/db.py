@@ -1,9 +1,15 @@
-from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime, ForeignKey
+from sqlalchemy import create_engine, event, select, func, case, and_, Column, Integer, BigInteger, String, Float, Date, DateTime, ForeignKey, UniqueConstraint, Index
 from sqlalchemy.dialects.postgresql import JSON
+from sqlalchemy.dialects import mysql, sqlite
 from sqlalchemy.orm import declarative_base, relationship, sessionmaker
-from sqlalchemy.sql import extract  # extract関数をインポート
-from datetime import datetime
+from sqlalchemy.pool import QueuePool
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 import json
+import os
+import threading
+import time
+from model.metrics import metrics
 
 # ベースクラスの作成
 Base = declarative_base()
@@ -37,6 +43,7 @@ class User(Base):
 # 健康データテーブルのモデル
 class FitData(Base):
     __tablename__ = 'tbl_fit'
+    __table_args__ = (UniqueConstraint('user_id', 'datetime'), Index('idx_user_datetime', 'user_id', 'datetime'))
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     user_id = Column(Integer, ForeignKey('tbl_user.user_id'), nullable=False)
@@ -49,6 +56,150 @@ class FitData(Base):
     # リレーションシップ
     user = relationship("User", back_populates="fit_data")
 
+# Google Fitの同期位置(watermark)テーブルのモデル
+class SyncWatermark(Base):
+    __tablename__ = 'tbl_sync_watermark'
+
+    user_id = Column(Integer, ForeignKey('tbl_user.user_id'), primary_key=True)
+    data_source = Column(String, primary_key=True)
+    last_modified_millis = Column(BigInteger, nullable=False)  # 最後に取得した変更のmodifiedTimeMillis
+    updated_at = Column(DateTime, nullable=False)
+
+# backfillの進捗テーブルのモデル
+# 書き込み終わったユーザ・日(JST)を1行ずつ持ち、再実行時はその日を取得しない
+class BackfillCheckpoint(Base):
+    __tablename__ = 'tbl_backfill_checkpoint'
+
+    user_id = Column(Integer, ForeignKey('tbl_user.user_id'), primary_key=True)
+    day = Column(Date, primary_key=True)
+    updated_at = Column(DateTime, nullable=False)
+
+# ユーザごとの月次集計テーブルのモデル
+# tbl_fitを書き込むたびに、書き込んだ月だけを集計し直し、その月以降の累計を計算し直す
+# ダッシュボードの月単位の表示とロール判定に使う
+class FitMonthly(Base):
+    __tablename__ = 'tbl_fit_monthly'
+
+    user_id = Column(Integer, ForeignKey('tbl_user.user_id'), primary_key=True)
+    month = Column(Date, primary_key=True)  # 月の1日
+    days = Column(Integer, nullable=False)
+    total_steps = Column(BigInteger, nullable=False)
+    total_distance = Column(Float, nullable=False)  # 月の累積距離
+    running_steps = Column(BigInteger, nullable=False, default=0)  # 最初の月からこの月までの累計
+    running_distance = Column(Float, nullable=False, default=0.0)
+    avg_weight = Column(Float)  # 記録のある日(0以外)の平均
+    avg_fat = Column(Float)
+    max_steps = Column(Integer)
+    min_steps = Column(Integer)
+    days_over_10000 = Column(Integer, nullable=False)  # 10000歩を超えた日数
+    updated_at = Column(DateTime, nullable=False)
+
+# データの更新回数テーブルのモデル
+# tbl_fitを書き込むたびに、書き込んだユーザのグループのversionを増やし、ダッシュボードのキャッシュの無効化に使う
+class DataVersion(Base):
+    __tablename__ = 'tbl_data_version'
+
+    name = Column(String, primary_key=True)
+    version = Column(BigInteger, nullable=False)
+    updated_at = Column(DateTime, nullable=False)
+
+# 日付の範囲は全て半開区間[start, end)で扱う
+# extract()で年月日を比較するとidx_user_datetimeの範囲検索が使えないため
+
+# 指定した日時を含む月の範囲を返す
+def get_month_range(dt):
+    start = datetime(dt.year, dt.month, 1)
+    end = datetime(dt.year + dt.month // 12, dt.month % 12 + 1, 1)
+    return start, end
+
+# 今月の範囲を返す。月初だけは先月の範囲を返す
+def get_current_month_range(now=None):
+    now = now or datetime.now()
+    if now.day == 1:
+        now -= timedelta(days=1)
+    return get_month_range(now)
+
+# [start, end)を含む月単位の範囲を返す（startは月初に、endは翌月初に広げる）
+def get_whole_month_range(start, end):
+    month_start, _ = get_month_range(start)
+    _, month_end = get_month_range(end - timedelta(microseconds=1))
+    return month_start, month_end
+
+# 指定した日時を含む日の範囲を返す
+def get_day_range(dt):
+    start = datetime(dt.year, dt.month, dt.day)
+    return start, start + timedelta(days=1)
+
+# ユーザの[start, end)のfit_dataを絞り込む条件
+def fit_data_between(user_id, start, end):
+    return and_(
+        FitData.user_id == user_id,
+        FitData.datetime >= start,
+        FitData.datetime < end
+    )
+
+# グループごとのtbl_fitの更新回数の名前
+def fit_data_version_name(group_id):
+    return f'{FitData.__tablename__}:group={group_id}'
+
+# ダッシュボードの集計の単位
+RESOLUTIONS = ('day', 'week', 'month')
+
+# datetimeを含む日・週(月曜始まり)・月の初日をDATEで返すSQLの式
+# tbl_fitのdatetimeはJSTの日の終わり(UTC)なので、日付部分がそのままJSTの日付になる
+def period_start(column, resolution, dialect_name):
+    if resolution not in RESOLUTIONS:
+        raise ValueError(f"未対応の集計単位です: {resolution}")
+    if dialect_name == 'sqlite':
+        if resolution == 'week':
+            return func.date(column, '-6 days', 'weekday 1')
+        if resolution == 'month':
+            return func.date(column, 'start of month')
+        return func.date(column)
+    if resolution == 'week':
+        return func.subdate(func.date(column), func.weekday(column))
+    if resolution == 'month':
+        return func.subdate(func.date(column), func.dayofmonth(column) - 1)
+    return func.date(column)
+
+# get_group_fit_frameで返すDataFrameの型
+FIT_FRAME_DTYPES = {
+    'user_id': 'int32',
+    'user_name': 'object',
+    'datetime': 'datetime64[ns]',
+    'steps': 'int32',
+    'distance': 'float32',
+    'weight': 'float32',
+    'fat': 'float32'
+}
+
+# get_group_fit_seriesで返すDataFrameの型
+FIT_SERIES_DTYPES = {
+    'user_id': 'int32',
+    'user_name': 'object',
+    'datetime': 'datetime64[ns]',
+    'steps': 'int64',
+    'distance': 'float64',
+    'weight': 'float32',
+    'fat': 'float32',
+    'cumulative_steps': 'int64',
+    'cumulative_distance': 'float64'
+}
+
+# read_fit_columnsで返すNumPy配列の型
+FIT_COLUMN_DTYPES = {
+    'id': 'int64',
+    'user_id': 'int32',
+    'datetime': 'datetime64[us]',
+    'steps': 'int32',
+    'distance': 'float32',
+    'weight': 'float32',
+    'fat': 'float32'
+}
+
+# bulk_upsert_fit_dataで更新する列
+FIT_DATA_COLUMNS = ('steps', 'distance', 'weight', 'fat')
+
 # AWS RDSの接続情報
 DATABASE_TYPE = 'mysql+pymysql'
 DB_HOST = 'rds-uap.ctc4g60uw746.ap-northeast-1.rds.amazonaws.com'
@@ -60,53 +211,234 @@ DB_PORT = '3306'  # MySQLのデフォルトポート
 # 接続URLを生成
 DATABASE_URL = f'{DATABASE_TYPE}://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}'
 
+# コネクションプールの設定（環境変数で上書き可能）
+DB_POOL_SIZE = int(os.environ.get('UAP_DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.environ.get('UAP_DB_MAX_OVERFLOW', 10))
+DB_POOL_TIMEOUT = int(os.environ.get('UAP_DB_POOL_TIMEOUT', 30))
+DB_POOL_RECYCLE = int(os.environ.get('UAP_DB_POOL_RECYCLE', 3600))  # RDSに切断される前に接続を作り直す
+DB_POOL_PRE_PING = os.environ.get('UAP_DB_POOL_PRE_PING', '1') == '1'  # 切れた接続を使う前に検知する
+
+class PoolStats:
+    """コネクションプールの統計。プールのサイズを決めるために使う"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.connects = 0
+        self.checkouts = 0
+        self.checkins = 0
+        self.invalidations = 0
+        self.max_checked_out = 0
+        self.wait_count = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self._checked_out = 0
+
+    def attach(self, engine):
+        event.listen(engine, 'connect', self.on_connect)
+        event.listen(engine, 'checkout', self.on_checkout)
+        event.listen(engine, 'checkin', self.on_checkin)
+        event.listen(engine, 'invalidate', self.on_invalidate)
+
+    def on_connect(self, dbapi_connection, connection_record):
+        with self._lock:
+            self.connects += 1
+
+    def on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        with self._lock:
+            self.checkouts += 1
+            self._checked_out += 1
+            self.max_checked_out = max(self.max_checked_out, self._checked_out)
+
+    def on_checkin(self, dbapi_connection, connection_record):
+        with self._lock:
+            self._checked_out -= 1
+            self.checkins += 1
+
+    def on_invalidate(self, dbapi_connection, connection_record, exception):
+        with self._lock:
+            self.invalidations += 1
+
+    def record_wait(self, seconds):
+        with self._lock:
+            self.wait_count += 1
+            self.wait_total += seconds
+            self.wait_max = max(self.wait_max, seconds)
+
+    def snapshot(self, pool=None):
+        with self._lock:
+            stats = {
+                'connects': self.connects,
+                'checkouts': self.checkouts,
+                'checkins': self.checkins,
+                'invalidations': self.invalidations,
+                'max_checked_out': self.max_checked_out,
+                'wait_avg': self.wait_total / self.wait_count if self.wait_count else 0.0,
+                'wait_max': self.wait_max
+            }
+        if isinstance(pool, QueuePool):
+            stats.update({
+                'pool_size': pool.size(),
+                'checked_out': pool.checkedout(),
+                'overflow': pool.overflow()
+            })
+        return stats
+
+# プロセス全体のプールの統計
+pool_stats = PoolStats()
+
+class TimedQueuePool(QueuePool):
+    """接続の取得でプールが空くのを待った時間を記録するQueuePool"""
+    def _do_get(self):
+        # 空いている接続があるか、新しい接続を作れる場合は待たないので記録しない（接続を作る時間は待ち時間ではない）
+        if self._pool.qsize() > 0 or self._max_overflow < 0 or self._overflow < self._max_overflow:
+            return super()._do_get()
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            wait = time.perf_counter() - start
+            pool_stats.record_wait(wait)
+            metrics.observe('db.pool_wait', wait)
+
+def create_db_engine(url=DATABASE_URL):
+    db_engine = create_engine(
+        url,
+        poolclass=TimedQueuePool,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_pre_ping=DB_POOL_PRE_PING
+    )
+    pool_stats.attach(db_engine)
+    return db_engine
+
 # データベースとの接続設定
-engine = create_engine(DATABASE_URL)
+# engineはimport時には作らず、最初にセッションを作る時に作る（DBを使わないコマンドの起動を速くする）
+_engine = None
+_engine_lock = threading.Lock()
+
+def get_engine():
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                _engine = create_db_engine()
+                Session.configure(bind=_engine)
+    return _engine
+
+# 従来通りmodel.db.engineでも参照できるようにする
+def __getattr__(name):
+    if name == 'engine':
+        return get_engine()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+class LazySessionmaker(sessionmaker):
+    """セッションを作る時に初めてengineを作るsessionmaker"""
+    def __call__(self, **local_kw):
+        if self.kw.get('bind') is None and local_kw.get('bind') is None:
+            get_engine()
+        return super().__call__(**local_kw)
 
 # セッションの作成
-Session = sessionmaker(bind=engine)
+Session = LazySessionmaker()
+
+# プールの統計を取得する
+def get_pool_stats():
+    return pool_stats.snapshot(get_engine().pool)
 
 class DatabaseClient:
-    def __init__(self):
-        self.session = Session()
+    def __init__(self, session_factory=Session):
+        self.session_factory = session_factory
+        self.session = session_factory()
+        self._unit_of_work = False
+        self._changed_fit_users = set()  # commit後にtbl_data_versionを更新するユーザ
+
+    @contextmanager
+    def unit_of_work(self):
+        """
+        with内のメソッド呼び出しを1つのセッション・1つのトランザクションで実行する
+        正常に抜けたらcommit、例外ならrollbackする
+        """
+        if self._unit_of_work:
+            yield self
+            return
+        self.session.close()
+        self._unit_of_work = True
+        try:
+            yield self
+            with metrics.span('db.commit'):
+                self.session.commit()
+            self._bump_fit_data_versions()
+        except:
+            self._changed_fit_users.clear()
+            self.session.rollback()
+            raise
+        finally:
+            self._unit_of_work = False
+            self.session.close()
+
+    # unit_of_workの中ではcommit/closeをまとめて最後に行う
+    def _commit(self):
+        if self._unit_of_work:
+            self.session.flush()
+        else:
+            with metrics.span('db.commit'):
+                self.session.commit()
+            self._bump_fit_data_versions()
+
+    def _rollback(self):
+        if not self._unit_of_work:
+            self._changed_fit_users.clear()
+            self.session.rollback()
+
+    def _close(self):
+        if not self._unit_of_work:
+            self.session.close()
 
     def get_all_users(self):
         try:
             users = self.session.query(User).all()
             return users
         finally:
-            self.session.close()
+            self._close()
 
     def get_user_fit_data(self, user_id):
         try:
             return self.session.query(FitData).filter_by(user_id=user_id).all()
         finally:
-            self.session.close()
+            self._close()
 
     def add_user(self, user_name, group_id=None):
         try:
             new_user = User(user_name=user_name, group_id=group_id)
             self.session.add(new_user)
-            self.session.commit()
+            self._commit()
         except:
-            self.session.rollback()
+            self._rollback()
             raise
         finally:
-            self.session.close()
+            self._close()
+
+    def get_all_groups(self):
+        try:
+            groups = self.session.query(Group).order_by(Group.group_id).all()
+            return groups
+        finally:
+            self._close()
 
     def get_users_by_group(self, group_id):
         try:
             users = self.session.query(User).filter_by(group_id=group_id).all()
             return users
         finally:
-            self.session.close()
+            self._close()
     
     def get_discord_guild_id(self, group_id):
         try:
             group = self.session.query(Group).filter_by(group_id=group_id).first()
             return group.discord_guild_id
         finally:
-            self.session.close()
+            self._close()
 
     def add_fit_data(self, fit_data, datetime=datetime.now()):
         try:
@@ -115,16 +447,225 @@ class DatabaseClient:
                 datetime=datetime,
                 steps=fit_data['steps'],
                 distance=fit_data['distance'],
-                weight=fit_data['weight'],
-                fat=fit_data['body_fat_percentage']
+                weight=fit_data['weight'] or None,
+                fat=fit_data['body_fat_percentage'] or None
             )
             self.session.add(new_fit_data)
-            self.session.commit()
+            self._refresh_fit_monthly({(new_fit_data.user_id, datetime)})
+            self._changed_fit_users.add(new_fit_data.user_id)
+            self._commit()
         except:
-            self.session.rollback()
+            self._rollback()
             raise
         finally:
-            self.session.close()
+            self._close()
+    
+    def bulk_upsert_fit_data(self, records, update_columns=FIT_DATA_COLUMNS, insert_missing=True):
+        """
+        fit_dataのリストを1トランザクション・1ステートメントでまとめて書き込む
+        同じユーザ・同じ日のデータがあればupdate_columnsだけを更新し、なければ追加する
+        insert_missing=Falseの場合は既存データの更新だけを行う
+        (追加した件数, 更新した件数) を返す
+        """
+        if not records:
+            return 0, 0
+        try:
+            # 同じユーザ・同じ日のデータが複数あれば後のものを優先する
+            rows = {}
+            for record in records:
+                row = self._to_fit_data_row(record)
+                rows[(row['user_id'], row['datetime'].date())] = row
+
+            # 既存データは時刻付きで保存されているので、日単位で突き合わせて既存の日時を使う
+            existing_datetimes = self._get_existing_fit_datetimes(rows)
+
+            values = []
+            inserted = updated = 0
+            for key, row in rows.items():
+                if key in existing_datetimes:
+                    row['datetime'] = existing_datetimes[key]
+                    updated += 1
+                elif insert_missing:
+                    inserted += 1
+                else:
+                    continue
+                values.append(row)
+            if not values:
+                return 0, 0
+
+            self.session.execute(self._upsert_statement(values, update_columns))
+            self._refresh_fit_monthly({(row['user_id'], row['datetime']) for row in values})
+            self._changed_fit_users.update(row['user_id'] for row in values)
+            self._commit()
+            return inserted, updated
+        except:
+            self._rollback()
+            raise
+        finally:
+            self._close()
+
+    # (user_id, 日付)の集まりについて、既存データの {(user_id, 日付): 日時} を返す
+    def _get_existing_fit_datetimes(self, keys):
+        days = [day for _, day in keys]
+        start, _ = get_day_range(min(days))
+        _, end = get_day_range(max(days))
+        existing_data = self.session.query(FitData.user_id, FitData.datetime).filter(
+            FitData.user_id.in_({user_id for user_id, _ in keys}),
+            FitData.datetime >= start,
+            FitData.datetime < end
+        ).all()
+        existing_datetimes = {}
+        for user_id, existing_datetime in existing_data:
+            key = (user_id, existing_datetime.date())
+            if key in keys:
+                existing_datetimes.setdefault(key, existing_datetime)
+        return existing_datetimes
+
+    @staticmethod
+    def _to_fit_data_row(record):
+        # tz付きのdatetimeはそのままの日付・時刻で保存する（add_fit_dataと同じ）
+        # weight,fatが未計測(0)の日はNULLで保存し、直近の体重として引き継がれないようにする
+        return {
+            'user_id': record['user_id'],
+            'datetime': record['datetime'].replace(tzinfo=None),
+            'steps': record['steps'],
+            'distance': record['distance'],
+            'weight': record['weight'] or None,
+            'fat': record['body_fat_percentage'] or None
+        }
+
+    def _upsert_statement(self, values, update_columns):
+        # MySQLはON DUPLICATE KEY UPDATE、local用のSQLiteはON CONFLICTで書き込む
+        dialect = self.session.get_bind().dialect.name
+        if dialect == 'mysql':
+            stmt = mysql.insert(FitData).values(values)
+            return stmt.on_duplicate_key_update({column: stmt.inserted[column] for column in update_columns})
+        if dialect == 'sqlite':
+            stmt = sqlite.insert(FitData).values(values)
+            return stmt.on_conflict_do_update(
+                index_elements=['user_id', 'datetime'],
+                set_={column: stmt.excluded[column] for column in update_columns}
+            )
+        raise ValueError(f"{dialect} はbulk_upsert_fit_dataに対応していません")
+    
+    # 書き込んだ(user_id, 日時)を含む月の集計だけをtbl_fitから計算し直す（呼び出し元のトランザクション内で実行する）
+    def _refresh_fit_monthly(self, user_datetimes):
+        self.session.flush()
+        now = datetime.now()
+        user_months = {(user_id, get_month_range(dt)[0]) for user_id, dt in user_datetimes}
+        for user_id, month_start in user_months:
+            start, end = get_month_range(month_start)
+            stats = self.session.execute(select(
+                func.count(FitData.id),
+                func.coalesce(func.sum(FitData.steps), 0),
+                func.coalesce(func.sum(FitData.distance), 0.0),
+                func.max(FitData.steps),
+                func.min(FitData.steps),
+                func.coalesce(func.sum(case((FitData.steps > 10000, 1), else_=0)), 0),
+                func.avg(func.nullif(FitData.weight, 0)),
+                func.avg(func.nullif(FitData.fat, 0))
+            ).where(fit_data_between(user_id, start, end))).one()
+            self.session.merge(FitMonthly(
+                user_id=user_id,
+                month=month_start.date(),
+                days=stats[0],
+                total_steps=stats[1],
+                total_distance=stats[2],
+                max_steps=stats[3],
+                min_steps=stats[4],
+                days_over_10000=stats[5],
+                avg_weight=stats[6],
+                avg_fat=stats[7],
+                updated_at=now
+            ))
+        self.session.flush()
+
+        # 書き込んだ最初の月以降の累計を、その前の月の累計から計算し直す
+        first_months = {}
+        for user_id, month_start in user_months:
+            first_months[user_id] = min(first_months.get(user_id, month_start), month_start)
+        for user_id, first_month in first_months.items():
+            previous = self.session.execute(select(FitMonthly.running_steps, FitMonthly.running_distance).where(
+                FitMonthly.user_id == user_id,
+                FitMonthly.month < first_month.date()
+            ).order_by(FitMonthly.month.desc()).limit(1)).first()
+            running_steps, running_distance = previous or (0, 0.0)
+            monthly_list = self.session.scalars(select(FitMonthly).where(
+                FitMonthly.user_id == user_id,
+                FitMonthly.month >= first_month.date()
+            ).order_by(FitMonthly.month))
+            for monthly in monthly_list:
+                running_steps += monthly.total_steps
+                running_distance += monthly.total_distance
+                monthly.running_steps = running_steps
+                monthly.running_distance = running_distance
+
+    def get_group_fit_monthly(self, group_id, month_start):
+        """指定したgroupの全ユーザの月次集計をDataFrameで返す（1ユーザ1行）"""
+        try:
+            stmt = select(
+                FitMonthly.user_id,
+                User.user_name,
+                FitMonthly.days,
+                FitMonthly.total_steps,
+                FitMonthly.total_distance,
+                FitMonthly.max_steps,
+                FitMonthly.min_steps,
+                FitMonthly.days_over_10000
+            ).join(User, User.user_id == FitMonthly.user_id).where(
+                User.group_id == group_id,
+                FitMonthly.month == month_start.date()
+            ).order_by(FitMonthly.user_id)
+            result = self.session.execute(stmt)
+            import pandas as pd  # pandasは読み込みに時間がかかるので使う時に読み込む
+            return pd.DataFrame(result.all(), columns=list(result.keys()))
+        finally:
+            self._close()
+
+    # tbl_fitを書き込んだユーザのグループの更新回数を増やす（データをcommitした後に呼び出す）
+    # 書き込みのトランザクションの外で、グループごとの行だけを更新するので、並列に書き込むグループ同士で待ち合わない
+    def _bump_fit_data_versions(self):
+        user_ids, self._changed_fit_users = self._changed_fit_users, set()
+        if not user_ids:
+            return
+        try:
+            group_ids = self.session.execute(
+                select(User.group_id).where(User.user_id.in_(user_ids), User.group_id.isnot(None)).distinct()
+            ).scalars().all()
+            now = datetime.now()
+            dialect = self.session.get_bind().dialect.name
+            # 同じ順番でロックを取る
+            for group_id in sorted(group_ids):
+                values = {'name': fit_data_version_name(group_id), 'version': 1, 'updated_at': now}
+                if dialect == 'mysql':
+                    stmt = mysql.insert(DataVersion).values(values).on_duplicate_key_update(
+                        version=DataVersion.version + 1, updated_at=now)
+                elif dialect == 'sqlite':
+                    stmt = sqlite.insert(DataVersion).values(values).on_conflict_do_update(
+                        index_elements=['name'], set_={'version': DataVersion.version + 1, 'updated_at': now})
+                else:
+                    raise ValueError(f"{dialect} はtbl_data_versionの更新に対応していません")
+                self.session.execute(stmt)
+            self.session.commit()
+        except Exception as e:
+            # データはcommit済みなので失敗させない（次に書き込んだ時に更新される）
+            self.session.rollback()
+            print(f"tbl_data_versionの更新に失敗しました: {e}")
+
+    def get_fit_data_version(self, group_id):
+        """
+        groupのtbl_fitが更新されたかを判定するための軽いクエリ
+        (グループの更新回数, tbl_fitの最大id) を返す。どちらかが変わればデータが変わっている
+        """
+        try:
+            stmt = select(
+                select(DataVersion.version).where(DataVersion.name == fit_data_version_name(group_id)).scalar_subquery(),
+                select(func.max(FitData.id)).scalar_subquery()
+            )
+            version, max_id = self.session.execute(stmt).one()
+            return version or 0, max_id or 0
+        finally:
+            self._close()
     
     # 最新データを取得するメソッド
     def get_latest_user_fit_data(self, user_id):
@@ -136,55 +677,196 @@ class DatabaseClient:
             ).order_by(FitData.datetime.desc()).limit(1).first()
             return fit_data
         finally:
-            self.session.close()
+            self._close()
+
+    def get_latest_user_body_data(self, user_id):
+        """
+        指定されたuser_idの、weightが記録されている最新のfit_dataを取得（なければNone）
+        weightがNULLや0の日（未計測の日）は飛ばす
+        """
+        try:
+            fit_data = self.session.query(FitData).filter(
+                FitData.user_id == user_id,
+                FitData.weight > 0
+            ).order_by(FitData.datetime.desc()).limit(1).first()
+            return fit_data
+        finally:
+            self._close()
     
     def get_user_fit_data_for_current_month(self, user_id):
         """指定されたuser_idの今月のfit_dataを取得"""
         try:
-            # 現在の年と月
-            now = datetime.now()
-            current_year = now.year
-            current_month = now.month
-            
-            # 月初だけは先月のデータを表示
-            if now.day == 1:
-                if current_month == 1:
-                    current_month = 12
-                else:
-                    current_month-= 1
+            start, end = get_current_month_range()
 
             # 指定したユーザーの今月のデータを取得
             fit_data = self.session.query(FitData).filter(
-                FitData.user_id == user_id,
-                extract('year', FitData.datetime) == current_year,
-                extract('month', FitData.datetime) == current_month
+                fit_data_between(user_id, start, end)
             ).all()
             return fit_data
         finally:
-            self.session.close()
+            self._close()
+    
+    def get_group_fit_frame(self, group_id, start, end):
+        """
+        指定したgroupの全ユーザの[start, end)のfit_dataを1回のクエリで取得し、DataFrameで返す
+        ORMのオブジェクトは作らずに、ユーザ名付きの行をそのままDataFrameにする
+        """
+        try:
+            stmt = select(
+                FitData.user_id,
+                User.user_name,
+                FitData.datetime,
+                FitData.steps,
+                FitData.distance,
+                FitData.weight,
+                FitData.fat
+            ).join(User, User.user_id == FitData.user_id).where(
+                User.group_id == group_id,
+                FitData.datetime >= start,
+                FitData.datetime < end
+            ).order_by(FitData.user_id, FitData.datetime)
+            import pandas as pd  # pandasは読み込みに時間がかかるので使う時に読み込む
+            df = pd.DataFrame(self.session.execute(stmt).all(), columns=list(FIT_FRAME_DTYPES))
+            df['steps'] = df['steps'].fillna(0)
+            return df.astype(FIT_FRAME_DTYPES)
+        finally:
+            self._close()
+
+    def get_group_fit_series(self, group_id, start, end, resolution='day'):
+        """
+        指定したgroupの全ユーザの[start, end)のfit_dataを、resolution(day/week/month)ごとにSQLで集計して返す
+          steps, distance: 合計
+          weight, fat: 記録のある日(0以外)の平均
+          cumulative_steps, cumulative_distance: startからの累計（ウィンドウ関数）
+        グラフに描く行数だけを受け取るので、期間が長くてもDBから転送する量が増えない
+        resolution='month'で期間が月単位の場合は、tbl_fitではなく月次集計(tbl_fit_monthly)から読む
+        """
+        if resolution == 'month' and (start, end) == get_whole_month_range(start, end):
+            return self._get_group_fit_monthly_series(group_id, start, end)
+        try:
+            period = period_start(FitData.datetime, resolution, self.session.get_bind().dialect.name).label('period')
+            grouped = select(
+                FitData.user_id,
+                User.user_name,
+                period,
+                func.sum(func.coalesce(FitData.steps, 0)).label('steps'),
+                func.sum(func.coalesce(FitData.distance, 0)).label('distance'),
+                func.avg(func.nullif(FitData.weight, 0)).label('weight'),
+                func.avg(func.nullif(FitData.fat, 0)).label('fat')
+            ).join(User, User.user_id == FitData.user_id).where(
+                User.group_id == group_id,
+                FitData.datetime >= start,
+                FitData.datetime < end
+            ).group_by(FitData.user_id, User.user_name, period).subquery()
+
+            stmt = select(
+                grouped.c.user_id,
+                grouped.c.user_name,
+                grouped.c.period,
+                grouped.c.steps,
+                grouped.c.distance,
+                grouped.c.weight,
+                grouped.c.fat,
+                func.sum(grouped.c.steps).over(partition_by=grouped.c.user_id, order_by=grouped.c.period),
+                func.sum(grouped.c.distance).over(partition_by=grouped.c.user_id, order_by=grouped.c.period)
+            ).order_by(grouped.c.user_id, grouped.c.period)
+            import pandas as pd  # pandasは読み込みに時間がかかるので使う時に読み込む
+            df = pd.DataFrame(self.session.execute(stmt).all(), columns=list(FIT_SERIES_DTYPES))
+            return df.astype(FIT_SERIES_DTYPES)
+        finally:
+            self._close()
+    
+    def _get_group_fit_monthly_series(self, group_id, start, end):
+        # get_group_fit_seriesと同じ列を月次集計から返す
+        # startからの累計は、各月までの累計から期間の最初の月より前の累計を引いて求める
+        try:
+            offset_steps = func.first_value(FitMonthly.running_steps - FitMonthly.total_steps).over(
+                partition_by=FitMonthly.user_id, order_by=FitMonthly.month)
+            offset_distance = func.first_value(FitMonthly.running_distance - FitMonthly.total_distance).over(
+                partition_by=FitMonthly.user_id, order_by=FitMonthly.month)
+            stmt = select(
+                FitMonthly.user_id,
+                User.user_name,
+                FitMonthly.month,
+                FitMonthly.total_steps,
+                FitMonthly.total_distance,
+                FitMonthly.avg_weight,
+                FitMonthly.avg_fat,
+                FitMonthly.running_steps - offset_steps,
+                FitMonthly.running_distance - offset_distance
+            ).join(User, User.user_id == FitMonthly.user_id).where(
+                User.group_id == group_id,
+                FitMonthly.month >= start.date(),
+                FitMonthly.month < end.date(),
+                FitMonthly.days > 0
+            ).order_by(FitMonthly.user_id, FitMonthly.month)
+            import pandas as pd  # pandasは読み込みに時間がかかるので使う時に読み込む
+            df = pd.DataFrame(self.session.execute(stmt).all(), columns=list(FIT_SERIES_DTYPES))
+            return df.astype(FIT_SERIES_DTYPES)
+        finally:
+            self._close()
+    
+    def read_fit_columns(self, columns=tuple(FIT_COLUMN_DTYPES), user_ids=None, start=None, end=None, chunk_size=10000):
+        """
+        tbl_fitを列ごとのNumPy配列 {列名: ndarray} で読み込む
+        ORMのオブジェクトを作らず、chunk_size行ずつストリーミングして事前に確保した配列に詰める
+        columnsで必要な列だけを読み込める
+        """
+        import numpy as np  # numpyは読み込みに時間がかかるので使う時に読み込む
+        try:
+            conditions = []
+            if user_ids is not None:
+                conditions.append(FitData.user_id.in_(user_ids))
+            if start is not None:
+                conditions.append(FitData.datetime >= start)
+            if end is not None:
+                conditions.append(FitData.datetime < end)
+
+            # 配列を事前に確保するために件数を数える
+            count = self.session.execute(select(func.count()).select_from(FitData).where(*conditions)).scalar()
+            arrays = {column: np.empty(count, dtype=FIT_COLUMN_DTYPES[column]) for column in columns}
+
+            # stepsは整数の配列に入れるのでNULLは0にする（小数の列のNULLはNaNになる）
+            selected = [func.coalesce(FitData.steps, 0) if column == 'steps' else getattr(FitData, column) for column in columns]
+            stmt = select(*selected).where(*conditions).order_by(FitData.user_id, FitData.datetime)
+            # ORMの結果処理を通さないようにConnectionで直接実行する
+            result = self.session.connection().execution_options(yield_per=chunk_size).execute(stmt)
+
+            filled = 0
+            for rows in result.partitions():
+                # 件数を数えた後に行が増えていた場合は配列を広げる
+                if filled + len(rows) > count:
+                    count = filled + len(rows)
+                    arrays = {column: np.resize(array, count) for column, array in arrays.items()}
+                for column, values in zip(columns, zip(*rows)):
+                    arrays[column][filled:filled + len(rows)] = values
+                filled += len(rows)
+            return {column: array[:filled] for column, array in arrays.items()}
+        finally:
+            self._close()
     
     def update_fit_data(self, fit_data):
         """データベースに該当日のデータがあれば更新"""
         try:
             # 該当のデータが存在するかを確認
+            start, end = get_day_range(fit_data['datetime'])
             existing_data = self.session.query(FitData).filter(
-                FitData.user_id == fit_data['user_id'],
-                extract('year', FitData.datetime) == fit_data['datetime'].year,
-                extract('month', FitData.datetime) == fit_data['datetime'].month,
-                extract('day', FitData.datetime) == fit_data['datetime'].day
+                fit_data_between(fit_data['user_id'], start, end)
             ).first()
             # データが既存の場合のみ更新する
             if existing_data:
                 existing_data.steps = fit_data['steps']
                 existing_data.distance = fit_data['distance']
+                self._refresh_fit_monthly({(existing_data.user_id, existing_data.datetime)})
+                self._changed_fit_users.add(existing_data.user_id)
                 
             # データベースに反映
-            self.session.commit()
+            self._commit()
         except:
-            self.session.rollback()
+            self._rollback()
             raise
         finally:
-            self.session.close()
+            self._close()
     
     # ユーザーのdiscord_rolesを更新するメソッド
     def update_discord_roles(self, user_id, roles):
@@ -194,12 +876,96 @@ class DatabaseClient:
             if user:
                 # rolesリストをJSON形式に変換してdiscord_rolesカラムに設定
                 user.discord_roles = json.dumps(roles)
-                self.session.commit()
+                self._commit()
                 print(f"User ID {user_id} のdiscord_rolesを更新しました。")
             else:
                 print(f"User ID {user_id} が見つかりません。")
         except Exception as e:
-            self.session.rollback()
+            # unit_of_workの中ではまとめてrollbackできるように呼び出し元に投げる
+            if self._unit_of_work:
+                raise
+            self._rollback()
             print(f"エラーが発生しました: {e}")
         finally:
-            self.session.close()
+            self._close()
+
+    # ユーザのdata sourceごとのwatermarkを取得するメソッド
+    def get_sync_watermarks(self, user_id):
+        """{data_source: last_modified_millis} を返す"""
+        try:
+            watermarks = self.session.query(SyncWatermark).filter_by(user_id=user_id).all()
+            return {watermark.data_source: watermark.last_modified_millis for watermark in watermarks}
+        finally:
+            self._close()
+
+    def get_backfill_checkpoints(self, user_ids, since):
+        """since以降にbackfillが終わった日を {user_id: set(date)} で返す"""
+        try:
+            stmt = select(BackfillCheckpoint.user_id, BackfillCheckpoint.day).where(
+                BackfillCheckpoint.user_id.in_(user_ids),
+                BackfillCheckpoint.day >= since
+            )
+            checkpoints = {}
+            for user_id, day in self.session.execute(stmt):
+                checkpoints.setdefault(user_id, set()).add(day)
+            return checkpoints
+        finally:
+            self._close()
+
+    # 書き込んだfit_dataのユーザ・日をbackfillの進捗として記録するメソッド
+    # fit_dataと同じunit_of_workの中で呼び出す
+    def add_backfill_checkpoints(self, records):
+        try:
+            now = datetime.now()
+            values = [
+                {'user_id': record['user_id'], 'day': record['datetime'].date(), 'updated_at': now}
+                for record in records
+            ]
+            if values:
+                dialect = self.session.get_bind().dialect.name
+                if dialect == 'mysql':
+                    stmt = mysql.insert(BackfillCheckpoint).on_duplicate_key_update(updated_at=now)
+                elif dialect == 'sqlite':
+                    stmt = sqlite.insert(BackfillCheckpoint).on_conflict_do_update(
+                        index_elements=['user_id', 'day'], set_={'updated_at': now})
+                else:
+                    raise ValueError(f"{dialect} はadd_backfill_checkpointsに対応していません")
+                self.session.execute(stmt, values)
+            self._commit()
+        except:
+            self._rollback()
+            raise
+        finally:
+            self._close()
+
+    # backfillが最後まで終わったら、次の実行が最初から取り直すように進捗を削除するメソッド
+    def clear_backfill_checkpoints(self, user_ids, since):
+        try:
+            self.session.query(BackfillCheckpoint).filter(
+                BackfillCheckpoint.user_id.in_(user_ids),
+                BackfillCheckpoint.day >= since
+            ).delete(synchronize_session=False)
+            self._commit()
+        except:
+            self._rollback()
+            raise
+        finally:
+            self._close()
+
+    # ユーザのdata sourceごとのwatermarkを更新するメソッド
+    def update_sync_watermarks(self, user_id, watermarks):
+        try:
+            now = datetime.now()
+            for data_source, last_modified_millis in watermarks.items():
+                self.session.merge(SyncWatermark(
+                    user_id=user_id,
+                    data_source=data_source,
+                    last_modified_millis=last_modified_millis,
+                    updated_at=now
+                ))
+            self._commit()
+        except:
+            self._rollback()
+            raise
+        finally:
+            self._close()
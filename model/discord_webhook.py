@@ -1,9 +1,14 @@
 import requests
 import json
+import os
+import asyncio
+import aiohttp
 
 class DiscordWebhook:
     def __init__(self, webhook_url):
         self.webhook_url = webhook_url
+        # 同じWebhookへの送信はコネクションを使い回す
+        self.session = requests.Session()
 
     def send_message(self, message_content, image_path=None):
         if image_path:
@@ -11,14 +16,139 @@ class DiscordWebhook:
                 files = {
                     'file': image_file
                 }
-                response = requests.post(self.webhook_url, files=files, data={'payload_json': json.dumps({"content": message_content})})
+                response = self.session.post(self.webhook_url, files=files, data={'payload_json': json.dumps({"content": message_content})})
         else:
             message = {
                 "content": message_content
             }
-            response = requests.post(self.webhook_url, data=json.dumps(message), headers={"Content-Type": "application/json"})
-        
+            response = self.session.post(self.webhook_url, data=json.dumps(message), headers={"Content-Type": "application/json"})
+
         if response.status_code in [200, 204]:
             print("メッセージが正常に送信されました。")
         else:
             print(f"メッセージの送信に失敗しました。ステータスコード: {response.status_code}")
+
+class AsyncDiscordWebhook:
+    """
+    aiohttpのセッションを使い回す非同期のWebhookクライアント
+      async with AsyncDiscordWebhook(url) as webhook:
+          await webhook.send("...", file_path="image/graph.png")
+    レスポンスのX-RateLimit-*ヘッダを見て、残りがなくなったらリセットまで待ってから次を送る
+    429の場合はretry_afterだけ待って送り直す
+    """
+    MAX_RETRIES = 5
+    MAX_CONNECTIONS = 4
+
+    def __init__(self, webhook_url, session=None):
+        self.webhook_url = webhook_url
+        self.session = session
+        self._own_session = session is None
+        # Webhookのレート制限はWebhookごとなので、送信は1つずつ順番に行う
+        self._lock = asyncio.Lock()
+        self._reset_at = 0.0
+
+    async def __aenter__(self):
+        if self.session is None:
+            self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.MAX_CONNECTIONS))
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        if self._own_session and self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def send(self, content=None, embeds=None, file_path=None):
+        payload = {}
+        if content:
+            payload['content'] = content
+        if embeds:
+            payload['embeds'] = embeds
+        async with self._lock:
+            for _ in range(self.MAX_RETRIES):
+                await self.wait_rate_limit()
+                if file_path:
+                    # ファイルは読み込まずにストリームで送る
+                    with open(file_path, 'rb') as file:
+                        form = aiohttp.FormData()
+                        form.add_field('payload_json', json.dumps(payload), content_type='application/json')
+                        form.add_field('file', file, filename=os.path.basename(file_path))
+                        status, retry_after = await self.post(data=form)
+                else:
+                    status, retry_after = await self.post(json=payload)
+                if status != 429:
+                    return status in (200, 204)
+                print(f"Webhookのレート制限のため{retry_after}秒待ちます。")
+                self._reset_at = max(self._reset_at, asyncio.get_running_loop().time() + retry_after)
+            return False
+
+    async def post(self, **kwargs):
+        async with self.session.post(self.webhook_url, **kwargs) as response:
+            self.update_rate_limit(response.headers)
+            if response.status == 429:
+                body = await response.json(content_type=None)
+                return response.status, float(body.get('retry_after', 1.0))
+            if response.status not in (200, 204):
+                print(f"メッセージの送信に失敗しました。ステータスコード: {response.status}")
+            return response.status, 0.0
+
+    def update_rate_limit(self, headers):
+        remaining = headers.get('X-RateLimit-Remaining')
+        reset_after = headers.get('X-RateLimit-Reset-After')
+        if remaining is not None and reset_after is not None and int(remaining) == 0:
+            self._reset_at = asyncio.get_running_loop().time() + float(reset_after)
+
+    async def wait_rate_limit(self):
+        delay = self._reset_at - asyncio.get_running_loop().time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+class WebhookBatcher:
+    """
+    ユーザごとの通知を貯めておき、まとめて少ないメッセージ(embed)で送る
+    Discordの制限: embedのdescriptionは4096文字、1メッセージにembedは10個・合計6000文字まで
+    """
+    MAX_DESCRIPTION = 4096
+    MAX_EMBEDS = 10
+    MAX_MESSAGE_CHARS = 6000
+
+    def __init__(self, title=None):
+        self.title = title
+        self.lines = []
+
+    def add(self, line):
+        self.lines.append(line[:self.MAX_DESCRIPTION])
+
+    def messages(self):
+        """送信する各メッセージのembedのリスト（1メッセージに入るだけ詰める）"""
+        title_chars = len(self.title or '')
+        messages = []
+        embeds = []
+        chars = 0
+        for line in self.lines:
+            description = embeds[-1]['description'] if embeds else None
+            if description is not None and len(description) + 1 + len(line) <= self.MAX_DESCRIPTION \
+                    and chars + 1 + len(line) <= self.MAX_MESSAGE_CHARS:
+                # 今のembedに追加する
+                embeds[-1]['description'] = f'{description}\n{line}'
+                chars += 1 + len(line)
+                continue
+            if embeds and (len(embeds) >= self.MAX_EMBEDS or chars + title_chars + len(line) > self.MAX_MESSAGE_CHARS):
+                messages.append(embeds)
+                embeds = []
+                chars = 0
+            embed = {'description': line}
+            if self.title:
+                embed['title'] = self.title
+            embeds.append(embed)
+            chars += title_chars + len(line)
+        if embeds:
+            messages.append(embeds)
+        return messages
+
+    async def flush(self, webhook):
+        for embeds in self.messages():
+            await webhook.send(embeds=embeds)
+        self.lines = []
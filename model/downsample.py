@@ -0,0 +1,36 @@
+import numpy as np
+
+def lttb(x, y, threshold):
+    """
+    Largest-Triangle-Three-Bucketsでthreshold点に間引き、残す点のインデックスを返す
+    最初と最後の点は必ず残し、各バケットからは前後の点と作る三角形が最大になる点を選ぶので山や谷が残る
+    x: 単調増加の数値の配列（日時はint64のナノ秒などに変換して渡す）
+    """
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    x = np.asarray(x, dtype='float64')
+    y = np.asarray(y, dtype='float64')
+
+    indices = np.empty(threshold, dtype='int64')
+    indices[0] = 0
+    indices[-1] = n - 1
+    # 最初と最後を除いた点をthreshold - 2個のバケットに分ける
+    edges = np.linspace(1, n - 1, threshold - 1).astype('int64')
+    selected = 0
+    for i in range(threshold - 2):
+        start, end = edges[i], edges[i + 1]
+        # 次のバケットの平均の点（最後のバケットの次は最後の点）
+        if i + 2 < len(edges):
+            next_x = x[end:edges[i + 2]].mean()
+            next_y = y[end:edges[i + 2]].mean()
+        else:
+            next_x, next_y = x[n - 1], y[n - 1]
+        # 選んだ点・次のバケットの平均の点と作る三角形の面積(の2倍)
+        area = np.abs(
+            (x[selected] - next_x) * (y[start:end] - y[selected])
+            - (x[selected] - x[start:end]) * (next_y - y[selected])
+        )
+        selected = start + int(np.argmax(area))
+        indices[i + 1] = selected
+    return indices
@@ -0,0 +1,148 @@
+import os
+import threading
+from datetime import datetime, timezone, timedelta
+import numpy as np
+
+JST = timezone(timedelta(hours=9))
+
+# data sourceごとの値の型（stepsはintVal、それ以外はfpVal）
+VALUE_DTYPES = {
+    "steps": 'int64',
+    "distance": 'float64',
+    "weights": 'float64',
+    "body_fat": 'float64'
+}
+
+# アーカイブの保存先（環境変数で上書き可能）
+DEFAULT_ARCHIVE_DIR = os.environ.get('UAP_FIT_ARCHIVE_DIR', 'archive/fit')
+
+def point_dtype(key):
+    return np.dtype([('start_ns', 'int64'), ('end_ns', 'int64'), ('value', VALUE_DTYPES[key])])
+
+class FitArchive:
+    """
+    Google Fitから取得した生のpointを、ユーザ・月・data sourceごとのNumPyファイルに保存する
+      {archive_dir}/user={user_id}/month={YYYY-MM}/{data source key}.npy
+    各ファイルは (start_ns, end_ns, value) の構造化配列で、読み込みはメモリマップで行う
+    集計ルールを変えた時は、APIを叩かずにアーカイブからtbl_fitを作り直せる
+    """
+    def __init__(self, archive_dir=DEFAULT_ARCHIVE_DIR):
+        self.archive_dir = archive_dir
+        self._lock = threading.Lock()
+        self._partition_locks = {}  # ファイルごとのロック
+
+    def partition_path(self, user_id, month, key):
+        return os.path.join(self.archive_dir, f'user={user_id}', f'month={month}', f'{key}.npy')
+
+    # JSTの月ごとに振り分ける
+    @staticmethod
+    def month_of(nanos):
+        return datetime.fromtimestamp(nanos / 1e9, JST).strftime('%Y-%m')
+
+    # APIのpointsを、集計に使う値ごとの行に変換する
+    @staticmethod
+    def to_rows(key, points):
+        rows = []
+        for point in points:
+            start_ns = int(point['startTimeNanos'])
+            end_ns = int(point['endTimeNanos'])
+            if key in ("steps", "distance"):
+                # 合計する値は全て残す
+                field = 'intVal' if key == "steps" else 'fpVal'
+                for value in point['value']:
+                    rows.append((start_ns, end_ns, value.get(field, 0)))
+            elif point['value']:
+                # 体重・体脂肪率は最後の値だけを使う
+                rows.append((start_ns, end_ns, point['value'][-1].get('fpVal', 0.0)))
+        return np.array(rows, dtype=point_dtype(key))
+
+    def write(self, user_id, key, points, start_date, end_date):
+        """
+        [start_date, end_date)を取得したpointsで、アーカイブのその期間を置き換える
+        取り直した期間の古いpointは削除する（集計し直されて区切りや値が変わったpointを二重に数えない）
+        """
+        rows = self.to_rows(key, points)
+        start_ns = int(start_date.timestamp() * 1e9)
+        end_ns = int(end_date.timestamp() * 1e9)
+        months = np.array([self.month_of(row_start_ns) for row_start_ns in rows['start_ns']], dtype=object)
+        for month in sorted(set(self.months_between(start_date, end_date)) | set(months)):
+            path = self.partition_path(user_id, month, key)
+            new_rows = rows[months == month]
+            # 別のユーザ・月・data sourceのファイルは並列に書き込める
+            with self.partition_lock(path):
+                if os.path.exists(path):
+                    old_rows = np.load(path)
+                    replaced = (old_rows['start_ns'] >= start_ns) & (old_rows['start_ns'] < end_ns)
+                    if not replaced.any() and len(new_rows) == 0:
+                        continue
+                    new_rows = np.concatenate([old_rows[~replaced], new_rows])
+                elif len(new_rows) == 0:
+                    continue
+                # 期間より前から続くpointを取り直した場合の重複を除き、開始時刻順に並べる
+                new_rows = np.unique(new_rows)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                tmp_path = f'{path}.tmp.npy'
+                np.save(tmp_path, new_rows)
+                os.replace(tmp_path, path)
+
+    def partition_lock(self, path):
+        with self._lock:
+            return self._partition_locks.setdefault(path, threading.Lock())
+
+    # [start_date, end_date)にかかるJSTの月
+    @staticmethod
+    def months_between(start_date, end_date):
+        month = start_date.astimezone(JST)
+        month = datetime(month.year, month.month, 1)
+        last = (end_date - timedelta(microseconds=1)).astimezone(JST)
+        months = []
+        while (month.year, month.month) <= (last.year, last.month):
+            months.append(month.strftime('%Y-%m'))
+            month = datetime(month.year + month.month // 12, month.month % 12 + 1, 1)
+        return months
+
+    def read(self, user_id, key, start_date, end_date):
+        """[start_date, end_date)にかかる月のpointをメモリマップで読み込む"""
+        arrays = []
+        # 前月末から日をまたいでいるpointも含めるため、1日前の月から読み込む
+        first = (start_date - timedelta(days=1)).astimezone(JST)
+        month = datetime(first.year, first.month, 1)
+        last = end_date.astimezone(JST)
+        while (month.year, month.month) <= (last.year, last.month):
+            path = self.partition_path(user_id, month.strftime('%Y-%m'), key)
+            if os.path.exists(path):
+                arrays.append(np.load(path, mmap_mode='r'))
+            month = datetime(month.year + month.month // 12, month.month % 12 + 1, 1)
+        if not arrays:
+            return np.empty(0, dtype=point_dtype(key))
+        return np.concatenate(arrays) if len(arrays) > 1 else arrays[0]
+
+    def aggregate_days(self, user_id, start_date, days):
+        """
+        アーカイブからJSTの日ごとに集計する（GoogleFitClient.fetch_range_dataと同じ形式・同じ集計ルール）
+        start_dateはJSTの00:00
+        """
+        end_date = start_date + timedelta(days=days)
+        rows_by_key = {key: self.read(user_id, key, start_date, end_date) for key in VALUE_DTYPES}
+
+        results_list = []
+        for day in range(days):
+            day_start = start_date + timedelta(days=day)
+            day_end = day_start + timedelta(days=1)
+            day_start_nanos = int(day_start.timestamp() * 1e9)
+            day_end_nanos = int(day_end.timestamp() * 1e9)
+            day_values = {}
+            for key, rows in rows_by_key.items():
+                # 日をまたぐpointは両方の日に含める
+                mask = (rows['start_ns'] < day_end_nanos) & (
+                    (rows['end_ns'] > day_start_nanos) | (rows['start_ns'] >= day_start_nanos))
+                day_values[key] = rows['value'][mask]
+            results_list.append({
+                "user_id": user_id,
+                "steps": int(day_values["steps"].sum()),
+                "distance": sum((round(value / 1000, 3) for value in day_values["distance"].tolist()), 0.0),
+                "weight": sum((round(value, 1) for value in day_values["weights"].tolist()), 0.0),
+                "body_fat_percentage": sum(day_values["body_fat"].tolist(), 0.0),
+                "datetime": day_end # db探索用 dayのみ参照 一日ずらす
+            })
+        return results_list
@@ -0,0 +1,88 @@
+import os
+import json
+import hashlib
+import threading
+from datetime import datetime, timezone, timedelta
+
+# キャッシュの設定（環境変数で上書き可能）
+DEFAULT_CACHE_DIR = os.environ.get('UAP_FIT_CACHE_DIR', 'cache/fit')
+# この日数より前のデータは変わらないものとして扱う
+DEFAULT_SETTLED_DAYS = int(os.environ.get('UAP_FIT_CACHE_SETTLED_DAYS', 7))
+DEFAULT_MAX_BYTES = int(os.environ.get('UAP_FIT_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+
+class FitResponseCache:
+    """
+    Google Fitのdatasetのレスポンス(points)をディスクにキャッシュする
+    ユーザ・data source・期間から求めたハッシュをキーにする
+    確定した(settled_daysより前の)期間だけをキャッシュし、最近の期間は毎回APIから取り直す
+    合計サイズがmax_bytesを超えたら、最後に使われてから時間が経ったものから削除する
+    """
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, settled_days=DEFAULT_SETTLED_DAYS, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.settled_days = settled_days
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._size = None  # 初めて書き込む時にディレクトリを走査して求める
+
+    # この時刻より前に終わる期間は確定している
+    def settled_boundary(self):
+        return datetime.now(timezone.utc) - timedelta(days=self.settled_days)
+
+    def path(self, user_id, data_source, start_date, end_date):
+        dataset_id = f"{int(start_date.timestamp() * 1e9)}-{int(end_date.timestamp() * 1e9)}"
+        key = hashlib.sha256(f"{user_id}:{data_source}:{dataset_id}".encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, key[:2], f'{key}.json')
+
+    def get(self, user_id, data_source, start_date, end_date):
+        path = self.path(user_id, data_source, start_date, end_date)
+        try:
+            with open(path, 'r') as f:
+                points = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        # 最後に使った時刻としてmtimeを更新する
+        os.utime(path)
+        return points
+
+    def put(self, user_id, data_source, start_date, end_date, points):
+        if end_date > self.settled_boundary():
+            return
+        path = self.path(user_id, data_source, start_date, end_date)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(points, f, separators=(',', ':'))
+        size = os.path.getsize(tmp_path)
+        os.replace(tmp_path, path)
+        with self._lock:
+            if self._size is None:
+                self._size = self.scan_size()
+            else:
+                self._size += size
+            if self._size > self.max_bytes:
+                self.evict()
+
+    def entries(self):
+        for root, _, files in os.walk(self.cache_dir):
+            for file in files:
+                if file.endswith('.json'):
+                    path = os.path.join(root, file)
+                    stat = os.stat(path)
+                    yield stat.st_mtime, stat.st_size, path
+
+    def scan_size(self):
+        return sum(size for _, size, _ in self.entries())
+
+    # 最後に使われてから時間が経ったものから、max_bytesの9割以下になるまで削除する
+    def evict(self):
+        entries = sorted(self.entries())
+        size = sum(entry_size for _, entry_size, _ in entries)
+        for _, entry_size, path in entries:
+            if size <= self.max_bytes * 0.9:
+                break
+            try:
+                os.remove(path)
+                size -= entry_size
+            except FileNotFoundError:
+                pass
+        self._size = size
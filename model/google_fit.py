@@ -1,9 +1,90 @@
 import os
+import json
+import time
+import threading
 from datetime import datetime, timezone, timedelta
+import httplib2
 from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
-from googleapiclient.discovery import build
+from google_auth_httplib2 import AuthorizedHttp
+from googleapiclient import discovery_cache
+from googleapiclient.discovery import build_from_document
+from model.fit_archive import FitArchive
+from model.fit_cache import FitResponseCache
+from model.metrics import metrics
+from model.rate_limit import FitRateLimiter
+
+JST = timezone(timedelta(hours=9))
+NANOS_PER_DAY = 24 * 60 * 60 * 10**9
+
+# watermarkがまだないユーザ・data sourceを初回同期する日数
+INITIAL_SYNC_DAYS = 4
+
+# dataPointChangesで1ページに取得する変更の件数
+CHANGES_PAGE_SIZE = 1000
+
+# iter_range_dataで1回に取得する日数（環境変数で上書き可能）
+RANGE_WINDOW_DAYS = int(os.environ.get('UAP_RANGE_WINDOW_DAYS', 30))
+
+class FitServiceFactory:
+    """
+    Fitness APIのserviceを生成するファクトリ
+    discovery documentは1度だけ読み込み、HTTPコネクションはスレッドごとに使い回す
+    ユーザごとに差し替えるのは認証情報だけ
+    http_factoryを差し替えると、Googleに接続せずにローカルの偽のAPIに問い合わせられる
+    """
+    DISCOVERY_URL = 'https://www.googleapis.com/discovery/v1/apis/fitness/v1/rest'
+    DISCOVERY_CACHE_FILE = 'credential/fitness_v1_discovery.json'
+
+    def __init__(self, http_factory=httplib2.Http):
+        self.http_factory = http_factory
+        self._document = None
+        self._lock = threading.Lock()
+        # httplib2.Httpはスレッドセーフではないので、スレッドごとに1つ持つ
+        self._local = threading.local()
+
+    def get_document(self):
+        if self._document is None:
+            with self._lock:
+                if self._document is None:
+                    self._document = self.load_document()
+        return self._document
+
+    def load_document(self):
+        # google-api-python-clientに同梱されているdiscovery documentを優先する
+        content = discovery_cache.get_static_doc('fitness', 'v1')
+        # 同梱されていない場合はキャッシュファイル、なければダウンロードしてキャッシュする
+        if content is None and os.path.exists(self.DISCOVERY_CACHE_FILE):
+            with open(self.DISCOVERY_CACHE_FILE, 'r') as f:
+                content = f.read()
+        if content is None:
+            _, content = self.get_http().request(self.DISCOVERY_URL)
+            content = content.decode('utf-8')
+            with open(self.DISCOVERY_CACHE_FILE, 'w') as f:
+                f.write(content)
+        return json.loads(content)
+
+    def get_http(self):
+        http = getattr(self._local, 'http', None)
+        if http is None:
+            http = self.http_factory()
+            self._local.http = http
+        return http
+
+    def build(self, creds):
+        return build_from_document(self.get_document(), http=AuthorizedHttp(creds, http=self.get_http()))
+
+# プロセス全体で共有するファクトリ
+service_factory = FitServiceFactory()
+
+# 取得した生のpointを保存するアーカイブ
+fit_archive = FitArchive()
+
+# 確定した過去の日のレスポンスのキャッシュ
+fit_cache = FitResponseCache()
+
+# 全ユーザ・全スレッドで共有するAPI呼び出しの制限とリトライ
+fit_rate_limiter = FitRateLimiter()
 
 class GoogleFitClient:
     SCOPES = [
@@ -14,8 +95,21 @@ class GoogleFitClient:
     
     CREDENTIALS_FILE = 'credential/uap_credential.json'
 
-    def __init__(self, user_id):
+    DATA_SOURCES = {
+        "steps": "derived:com.google.step_count.delta:com.google.android.gms:estimated_steps",
+        "distance": "derived:com.google.distance.delta:com.google.android.gms:merge_distance_delta",
+        "weights": "derived:com.google.weight:com.google.android.gms:merge_weight",
+        "body_fat": "derived:com.google.body.fat.percentage:com.google.android.gms:merge_body_fat_percentage"
+    }
+    DATA_SOURCE_KEYS = {data_source: key for key, data_source in DATA_SOURCES.items()}
+
+    def __init__(self, user_id, service_factory=service_factory, archive=fit_archive, cache=fit_cache,
+                 rate_limiter=fit_rate_limiter):
         self.user_id = user_id
+        self.service_factory = service_factory
+        self.archive = archive  # Noneの場合はアーカイブしない
+        self.cache = cache  # Noneの場合はキャッシュしない
+        self.rate_limiter = rate_limiter  # Noneの場合は制限・リトライしない
         self.TOKEN_FILE = f'credential/user/{user_id}_token.json'  # ユーザーIDに基づいたトークンファイルのパス
         self.creds = self.get_credentials()
         self.service = self.build_service()
@@ -26,8 +120,11 @@ class GoogleFitClient:
             creds = Credentials.from_authorized_user_file(self.TOKEN_FILE, self.SCOPES)
         if not creds or not creds.valid:
             if creds and creds.expired and creds.refresh_token:
-                creds.refresh(Request())
+                with metrics.span('fit.oauth_refresh'):
+                    creds.refresh(Request())
             else:
+                # ブラウザでの認証は初回だけなので、その時に読み込む
+                from google_auth_oauthlib.flow import InstalledAppFlow
                 flow = InstalledAppFlow.from_client_secrets_file(self.CREDENTIALS_FILE, self.SCOPES)
                 creds = flow.run_local_server(port=8080)
             with open(self.TOKEN_FILE, 'w') as token:
@@ -35,7 +132,8 @@ class GoogleFitClient:
         return creds
 
     def build_service(self):
-        return build('fitness', 'v1', credentials=self.creds)
+        with metrics.span('fit.build_service'):
+            return self.service_factory.build(self.creds)
 
     # UTCで日またいでから実行する。前日の期間を取得する
     def get_dates(self):
@@ -61,23 +159,132 @@ class GoogleFitClient:
     """
     期間を指定してfitデータを取得する
     """
-    def fetch_data(self, data_source, start_date, end_date):
+    def fetch_data(self, data_source, start_date, end_date, refresh=False):
+        # refresh=Trueの場合は確定した日もキャッシュを使わずに取り直し、キャッシュを書き換える（後から変更があった日用）
+        if self.cache is None:
+            return self.fetch_data_from_api(data_source, start_date, end_date)
+
+        # 確定した日は1日ずつキャッシュを使い、キャッシュにない日はまとめてAPIから取得する
+        settled_boundary = self.cache.settled_boundary()
+        points = []
+        missing_days = []
+        day_start = start_date
+        while day_start + timedelta(days=1) <= min(end_date, settled_boundary):
+            day_end = day_start + timedelta(days=1)
+            cached = None if refresh else self.cache.get(self.user_id, data_source, day_start, day_end)
+            if cached is None:
+                missing_days.append((day_start, day_end))
+                metrics.count('fit.cache_miss')
+            else:
+                points += cached
+                metrics.count('fit.cache_hit')
+            day_start = day_end
+        for range_start, range_end in self.contiguous_ranges(missing_days):
+            range_points = self.fetch_data_from_api(data_source, range_start, range_end)
+            for missing_start, missing_end in missing_days:
+                if range_start <= missing_start and missing_end <= range_end:
+                    day_start_nanos = int(missing_start.timestamp() * 1e9)
+                    day_end_nanos = int(missing_end.timestamp() * 1e9)
+                    day_points = [p for p in range_points if self.point_in_day(p, day_start_nanos, day_end_nanos)]
+                    self.cache.put(self.user_id, data_source, missing_start, missing_end, day_points)
+            points += range_points
+        # 確定していない最近の日は毎回APIから取り直す
+        if day_start < end_date:
+            points += self.fetch_data_from_api(data_source, day_start, end_date)
+
+        # 日をまたぐpointは両方の日に含まれるので重複を除き、開始時刻順に並べる
+        unique_points = {}
+        for point in points:
+            unique_points.setdefault(json.dumps(point, sort_keys=True), point)
+        return sorted(unique_points.values(), key=lambda point: int(point['startTimeNanos']))
+
+    # 連続する日をまとめて1つの期間にする
+    @staticmethod
+    def contiguous_ranges(days):
+        ranges = []
+        for day_start, day_end in days:
+            if ranges and ranges[-1][1] == day_start:
+                ranges[-1] = (ranges[-1][0], day_end)
+            else:
+                ranges.append((day_start, day_end))
+        return ranges
+
+    def fetch_data_from_api(self, data_source, start_date, end_date):
         dataset_id = f"{int(start_date.timestamp() * 1e9)}-{int(end_date.timestamp() * 1e9)}"
-        dataset = self.service.users().dataSources().datasets().get(
-            userId='me',
-            dataSourceId=data_source,
-            datasetId=dataset_id
-        ).execute()
-        return dataset.get('point', [])
+        points = []
+        page_token = None
+        # 複数日をまとめて取得する場合はページングされるので全ページを取得する
+        while True:
+            request = self.service.users().dataSources().datasets().get(
+                userId='me',
+                dataSourceId=data_source,
+                datasetId=dataset_id,
+                pageToken=page_token
+            )
+            with metrics.span('fit.fetch_data'):
+                dataset = self.execute(request)
+            points += dataset.get('point', [])
+            page_token = dataset.get('nextPageToken')
+            if not page_token:
+                break
+        if self.archive is not None:
+            self.archive.write(self.user_id, self.DATA_SOURCE_KEYS[data_source], points, start_date, end_date)
+        return points
 
-    def fetch_combined_data(self, start_date=None, end_date=None):
-        data_sources = {
-            "steps": "derived:com.google.step_count.delta:com.google.android.gms:estimated_steps",
-            "distance": "derived:com.google.distance.delta:com.google.android.gms:merge_distance_delta",
-            "weights": "derived:com.google.weight:com.google.android.gms:merge_weight",
-            "body_fat": "derived:com.google.body.fat.percentage:com.google.android.gms:merge_body_fat_percentage"
-        }
+    def execute(self, request):
+        if self.rate_limiter is None:
+            return request.execute()
+        return self.rate_limiter.call(self.user_id, request.execute)
+
+    def fetch_changes(self, data_source, since_millis):
+        """
+        modifiedTimeMillisがsince_millisより新しい、追加・削除されたpointを返す
+        dataPointChangesは新しい変更から順に返るので、since_millis以前の変更が出てきたページで読むのをやめる
+        """
+        changes = []
+        page_token = None
+        while True:
+            request = self.service.users().dataSources().dataPointChanges().list(
+                userId='me',
+                dataSourceId=data_source,
+                limit=CHANGES_PAGE_SIZE,
+                pageToken=page_token
+            )
+            with metrics.span('fit.fetch_changes'):
+                response = self.execute(request)
+            page = response.get('deletedDataPoint', []) + response.get('insertedDataPoint', [])
+            newer = [point for point in page if int(point.get('modifiedTimeMillis', 0)) > since_millis]
+            changes += newer
+            page_token = response.get('nextPageToken')
+            if not page_token or len(newer) < len(page):
+                break
+        return changes
+
+    # 取得したpointsをresultsに集計する
+    def aggregate_points(self, results, key, points):
+        if key == "steps":
+            for point in points:
+                for value in point['value']:
+                    results["steps"] += value.get('intVal', 0)
+
+        elif key == "distance":
+            for point in points:
+                for value in point['value']:
+                    results["distance"] += round(((value.get('fpVal', 0.0))/1000), 3)
 
+        elif key == "weights":
+            for point in points:
+                if point['value']:  # 'value' が空でないことを確認
+                    # 最後の要素を取得して追加
+                    results["weight"] += round(point['value'][-1].get('fpVal', 0.0), 1)
+
+        elif key == "body_fat":
+            for point in points:
+                if point['value']:  # 'value' が空でないことを確認
+                    # 最後の要素を取得して追加
+                    results["body_fat_percentage"] += point['value'][-1].get('fpVal', 0.0)
+
+    def fetch_combined_data(self, start_date=None, end_date=None):
         results = {
             "user_id": self.user_id,
             "steps": 0,
@@ -90,81 +297,150 @@ class GoogleFitClient:
         if start_date == None or end_date == None:
             start_date, end_date = self.get_dates()
             
-        for key, data_source in data_sources.items():
+        for key, data_source in self.DATA_SOURCES.items():
             points = self.fetch_data(data_source, start_date, end_date)
-
-            if key == "steps":
-                for point in points:
-                    for value in point['value']:
-                        results["steps"] += value.get('intVal', 0)
-
-            elif key == "distance":
-                for point in points:
-                    for value in point['value']:
-                        results["distance"] += round(((value.get('fpVal', 0.0))/1000), 3)
-                        
-            elif key == "weights":
-                for point in points:
-                    if point['value']:  # 'value' が空でないことを確認
-                        # 最後の要素を取得して追加
-                        results["weight"] += round(point['value'][-1].get('fpVal', 0.0), 1)
-
-            elif key == "body_fat":
-                for point in points:
-                    if point['value']:  # 'value' が空でないことを確認
-                        # 最後の要素を取得して追加
-                        results["body_fat_percentage"] += point['value'][-1].get('fpVal', 0.0)
+            self.aggregate_points(results, key, points)
 
         return results
-    
-    # 日単位で期間を指定し、過去データを取得する
-    def fetch_past_data(self, days_ago_period):
-        data_sources = {
-            "steps": "derived:com.google.step_count.delta:com.google.android.gms:estimated_steps",
-            "distance": "derived:com.google.distance.delta:com.google.android.gms:merge_distance_delta",
-            "weights": "derived:com.google.weight:com.google.android.gms:merge_weight",
-            "body_fat": "derived:com.google.body.fat.percentage:com.google.android.gms:merge_body_fat_percentage"
+
+    # pointが[day_start, day_end)の日に含まれるか判定する
+    # 日ごとにdatasetを取得した場合と同じく、日をまたぐpointは両方の日に含める
+    @staticmethod
+    def point_in_day(point, day_start_nanos, day_end_nanos):
+        point_start = int(point['startTimeNanos'])
+        point_end = int(point['endTimeNanos'])
+        if point_start >= day_end_nanos:
+            return False
+        return point_end > day_start_nanos or point_start >= day_start_nanos
+
+    # 期間をまとめて取得し、data sourceごとのpointsを返す
+    def fetch_range_points(self, start_date, end_date):
+        return {
+            key: self.fetch_data(data_source, start_date, end_date)
+            for key, data_source in self.DATA_SOURCES.items()
         }
-        
+
+    # JSTの日単位にpointsを振り分けて集計する
+    def aggregate_days(self, points_by_key, start_date, days):
         results_list = []
-        
-        # 一日づつ過去データを取得する
-        for days_ago in range(1, days_ago_period, 1):
-            start_date, end_date = self.get_past_dates(days_ago)
+        for day in days:
+            day_start = start_date + timedelta(days=day)
+            day_end = day_start + timedelta(days=1)
+            day_start_nanos = int(day_start.timestamp() * 1e9)
+            day_end_nanos = int(day_end.timestamp() * 1e9)
             results = {
                 "user_id": self.user_id,
                 "steps": 0,
                 "distance": 0.0,
                 "weight": 0.0,
                 "body_fat_percentage": 0.0,
-                "datetime": start_date + timedelta(days=1)# db探索用 dayのみ参照 一日ずらす
+                "datetime": day_end # db探索用 dayのみ参照 一日ずらす
             }
-            
-            for key, data_source in data_sources.items():
-                points = self.fetch_data(data_source, start_date, end_date)
-
-                if key == "steps":
-                    for point in points:
-                        for value in point['value']:
-                            results["steps"] += value.get('intVal', 0)
-
-                elif key == "distance":
-                    for point in points:
-                        for value in point['value']:
-                            results["distance"] += round(((value.get('fpVal', 0.0))/1000), 3)
-                            
-                elif key == "weights":
-                    for point in points:
-                        if point['value']:  # 'value' が空でないことを確認
-                            # 最後の要素を取得して追加
-                            results["weight"] += round(point['value'][-1].get('fpVal', 0.0), 1)
-
-                elif key == "body_fat":
-                    for point in points:
-                        if point['value']:  # 'value' が空でないことを確認
-                            # 最後の要素を取得して追加
-                            results["body_fat_percentage"] += point['value'][-1].get('fpVal', 0.0)
-            # リストに追加
+            for key, points in points_by_key.items():
+                day_points = [p for p in points if self.point_in_day(p, day_start_nanos, day_end_nanos)]
+                self.aggregate_points(results, key, day_points)
             results_list.append(results)
         return results_list
-                
\ No newline at end of file
+
+    # 期間をまとめて取得し、JSTの日単位に振り分けて集計する
+    # data sourceごとに1回(+ページング)のリクエストで済むので、日数に比例してAPIを叩かない
+    def fetch_range_data(self, start_date, days):
+        points_by_key = self.fetch_range_points(start_date, start_date + timedelta(days=days))
+        return self.aggregate_days(points_by_key, start_date, range(days))
+
+    # [start_date, start_date + days)をwindow_days日ずつ取得し、日ごとの結果を古い順にyieldする
+    # skip_days(JSTの日付)に含まれる日は取得しない（backfillの再開用）
+    def iter_range_data(self, start_date, days, window_days=RANGE_WINDOW_DAYS, skip_days=()):
+        window = []
+        for day in range(days):
+            # 日の終わりの日付がJSTの日付
+            if (start_date + timedelta(days=day + 1)).date() in skip_days:
+                # 取得しない日で期間を区切る
+                yield from self.iter_window(start_date, window)
+                window = []
+                continue
+            window.append(day)
+            if len(window) >= window_days:
+                yield from self.iter_window(start_date, window)
+                window = []
+        yield from self.iter_window(start_date, window)
+
+    # 連続した日(start_dateからの日数のリスト)をまとめて取得して集計する
+    def iter_window(self, start_date, window):
+        if not window:
+            return
+        window_start = start_date + timedelta(days=window[0])
+        points_by_key = self.fetch_range_points(window_start, window_start + timedelta(days=len(window)))
+        yield from self.aggregate_days(points_by_key, window_start, range(len(window)))
+
+    # 指定時刻(ナノ秒)を含むJSTの日の00:00を返す（他の期間と揃えてUTCで返す）
+    @staticmethod
+    def jst_day_start(nanos):
+        dt = datetime.fromtimestamp(nanos / 1e9, JST)
+        return datetime(dt.year, dt.month, dt.day, tzinfo=JST).astimezone(timezone.utc)
+
+    # pointが含まれるJSTの日の00:00のリスト（point_in_dayと同じく、日をまたぐpointは両方の日に含める）
+    @classmethod
+    def point_days(cls, point):
+        point_start = int(point['startTimeNanos'])
+        first_day = cls.jst_day_start(point_start)
+        last_day = cls.jst_day_start(max(int(point['endTimeNanos']) - 1, point_start))
+        return [first_day + timedelta(days=day) for day in range((last_day - first_day).days + 1)]
+
+    def fetch_incremental_data(self, watermarks, initial_days=INITIAL_SYNC_DAYS):
+        """
+        前回同期した時刻(watermark)より後に追加・削除されたpointをdataPointChangesで取得し、
+        そのpointを含む日だけをdatasetから取り直して集計する
+        pointの時刻ではなく変更された時刻で追うので、スマホの同期が遅れて古い日のpointが届いても拾える
+        watermarksは {data_source: 最後に取得した変更のmodifiedTimeMillis}
+        watermarkがないdata sourceは直近initial_days日を集計し、同期を始めた時刻から変更を追う
+        (集計結果のリスト, 更新後のwatermarks) を返す
+        """
+        sync_started_millis = int(time.time() * 1000)
+        _, end_date = self.get_dates()  # 前日の24:00(JST)
+
+        affected_days = set()  # 集計し直すJSTの日の00:00
+        new_watermarks = dict(watermarks)
+        for data_source in self.DATA_SOURCES.values():
+            watermark = watermarks.get(data_source)
+            if watermark is None:
+                affected_days.update(end_date - timedelta(days=day) for day in range(1, initial_days + 1))
+                new_watermarks[data_source] = sync_started_millis
+                continue
+            new_watermark = watermark
+            unfinished = None  # まだ終わっていない日(今日)の変更のうち、最も古いもの
+            for point in self.fetch_changes(data_source, watermark):
+                modified = int(point['modifiedTimeMillis'])
+                new_watermark = max(new_watermark, modified)
+                for day in self.point_days(point):
+                    if day < end_date:
+                        affected_days.add(day)
+                    else:
+                        unfinished = modified if unfinished is None else min(unfinished, modified)
+            # 今日の変更は日が終わってから集計するので、次回もう一度読むようにwatermarkを手前で止める
+            if unfinished is not None:
+                new_watermark = min(new_watermark, unfinished - 1)
+            new_watermarks[data_source] = new_watermark
+        if not affected_days:
+            return [], new_watermarks
+
+        # 変更のあった日を連続する期間ごとに、全data sourceのpointを取り直して集計する
+        results_list = []
+        days = [(day, day + timedelta(days=1)) for day in sorted(affected_days)]
+        for range_start, range_end in self.contiguous_ranges(days):
+            points_by_key = {
+                key: self.fetch_data(data_source, range_start, range_end, refresh=True)
+                for key, data_source in self.DATA_SOURCES.items()
+            }
+            results_list += self.aggregate_days(points_by_key, range_start, range((range_end - range_start).days))
+        return results_list, new_watermarks
+    
+    # 日単位で期間を指定し、過去データを取得する
+    def fetch_past_data(self, days_ago_period):
+        # 一日づつ取得していた時と同じく、1日前から(days_ago_period - 1)日前までを新しい順に返す
+        if days_ago_period <= 1:
+            return []
+        oldest_start_date, _ = self.get_past_dates(days_ago_period - 1)
+        results_list = self.fetch_range_data(oldest_start_date, days_ago_period - 1)
+        results_list.reverse()
+        return results_list
@@ -0,0 +1,168 @@
+import os
+import queue
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from model.google_fit import GoogleFitClient
+from model.metrics import metrics
+from model.rate_limit import FIT_MAX_CONCURRENCY
+
+# 1回の取り込みで同時にGoogle Fitへ問い合わせるユーザ数の上限（環境変数で上書き可能）
+# 実際の同時リクエスト数はFitRateLimiterのAIMDが調整するので、その上限に合わせる
+# （少ないと、AIMDが同時実行数を増やしてもスループットが上がらない）
+DEFAULT_MAX_WORKERS = int(os.environ.get('UAP_INGEST_MAX_WORKERS', FIT_MAX_CONCURRENCY))
+
+# 取得はプロセス全体で1つのスレッドプールで行う（スレッド数はAIMDの上限と同じ）
+# run_groupsで複数グループを並列に取り込んでも、スレッド数はグループ数倍にならない
+_executor = None
+_executor_lock = threading.Lock()
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=FIT_MAX_CONCURRENCY, thread_name_prefix='fit-ingest')
+        return _executor
+
+# streamで取得済み・未処理のfit_dataを貯めておく件数の上限
+STREAM_QUEUE_SIZE = 1000
+
+# streamでユーザの取得が終わったことを表す
+_USER_DONE = object()
+
+class IngestResult:
+    """1回の取り込み処理の結果。成功したfit_dataと失敗したユーザのエラーをまとめて持つ"""
+    def __init__(self):
+        self.fit_data_list = []
+        self.errors = {}  # user_id -> Exception
+        self.watermarks = {}  # user_id -> {data_source: last_modified_millis}
+
+    def succeeded(self):
+        return not self.errors
+
+class FitIngestor:
+    """グループの全ユーザのfitデータを並列に取得する"""
+    def __init__(self, max_workers=None, client_factory=GoogleFitClient):
+        self.max_workers = max_workers or DEFAULT_MAX_WORKERS
+        self.client_factory = client_factory
+
+    # 前日のデータを全ユーザ分取得する
+    def run_daily(self, users):
+        return self.run(users, lambda gf_client: [gf_client.fetch_combined_data()])
+
+    # 過去数日分のデータを全ユーザ分取得する
+    def run_past(self, users, days_ago_period):
+        return self.run(users, lambda gf_client: gf_client.fetch_past_data(days_ago_period))
+
+    # 前回の同期位置(watermark)以降に変化のあった日だけを全ユーザ分取得する
+    def run_incremental(self, users, watermarks_by_user):
+        new_watermarks = {}
+        def fetch(gf_client):
+            results_list, new_watermarks[gf_client.user_id] = gf_client.fetch_incremental_data(
+                watermarks_by_user.get(gf_client.user_id, {}))
+            return results_list
+        result = self.run(users, fetch)
+        result.watermarks = {user_id: watermarks for user_id, watermarks in new_watermarks.items()
+                             if user_id not in result.errors}
+        return result
+
+    def run(self, users, fetch):
+        """
+        fetch(gf_client)はユーザごとのfit_dataのリストを返す関数
+        1ユーザの失敗(トークン切れなど)は他のユーザの処理を止めない
+        """
+        result = IngestResult()
+        # 共有のスレッドプールには同時にmax_workersユーザ分だけを入れ、1ユーザ終わるごとに次のユーザを入れる
+        executor = get_executor()
+        pending_users = iter(users)
+        futures = {}
+        def submit_next():
+            user = next(pending_users, None)
+            if user is not None:
+                futures[executor.submit(self.fetch_user, user, fetch)] = user
+        for _ in range(self.max_workers):
+            submit_next()
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                user = futures.pop(future)
+                submit_next()
+                try:
+                    result.fit_data_list += future.result()
+                except Exception as e:
+                    result.errors[user.user_id] = e
+                    metrics.count('ingest.failed_users')
+                    print(f"User ID {user.user_id} のfitデータ取得に失敗しました: {e}")
+        # 並列実行で順序が崩れるのでユーザ順に並べ直す
+        order = {user.user_id: i for i, user in enumerate(users)}
+        result.fit_data_list.sort(key=lambda fit_data: order[fit_data['user_id']])
+        return result
+
+    def stream(self, users, fetch, result=None):
+        """
+        fetch(gf_client)はユーザごとのfit_dataをyieldするジェネレータを返す関数
+        全ユーザを並列に取得し、取得できた順にfit_dataをyieldする
+        キューが一杯の間は取得を止めるので、ユーザ数 x 日数が大きくてもメモリ使用量は増えない
+        失敗したユーザはresult.errorsに記録する
+        """
+        result = result if result is not None else IngestResult()
+        records = queue.Queue(maxsize=STREAM_QUEUE_SIZE)
+        stopped = threading.Event()
+
+        # 呼び出し元が途中でやめた場合はFalseを返す
+        def put(item):
+            while not stopped.is_set():
+                try:
+                    records.put(item, timeout=1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def produce(user):
+            try:
+                if stopped.is_set():
+                    return
+                with metrics.span('ingest.user'):
+                    gf_client = self.client_factory(user.user_id)
+                    for gfd in fetch(gf_client):
+                        gfd['steps'] *= user.steps_coefficient #steps補正
+                        if not put(gfd):
+                            return
+            except Exception as e:
+                result.errors[user.user_id] = e
+                metrics.count('ingest.failed_users')
+                print(f"User ID {user.user_id} のfitデータ取得に失敗しました: {e}")
+            finally:
+                put(_USER_DONE)
+
+        # runと同じく、共有のスレッドプールには同時にmax_workersユーザ分だけを入れる
+        executor = get_executor()
+        pending_users = iter(users)
+        futures = []
+        def submit_next():
+            user = next(pending_users, None)
+            if user is not None:
+                futures.append(executor.submit(produce, user))
+        for _ in range(self.max_workers):
+            submit_next()
+        remaining = len(users)
+        try:
+            while remaining:
+                item = records.get()
+                if item is _USER_DONE:
+                    remaining -= 1
+                    submit_next()
+                    continue
+                yield item
+        finally:
+            # 途中でやめた場合も、取得中のユーザが止まるまで待ってから返す
+            stopped.set()
+            wait(futures)
+
+    def fetch_user(self, user, fetch):
+        with metrics.span('ingest.user'):
+            gf_client = self.client_factory(user.user_id)
+            gf_data = fetch(gf_client)
+        for gfd in gf_data:
+            gfd['steps'] *= user.steps_coefficient #steps補正
+        return gf_data
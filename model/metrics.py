@@ -0,0 +1,183 @@
+import os
+import json
+import time
+import bisect
+import cProfile
+import threading
+from contextlib import contextmanager
+
+# 計測の設定（環境変数で上書き可能）
+# UAP_METRICS=1 で計測を有効にする。無効の時はspan/countは何もしない
+METRICS_ENABLED = os.environ.get('UAP_METRICS', '0') == '1'
+METRICS_DIR = os.environ.get('UAP_METRICS_DIR', 'metrics')
+# UAP_PROFILE=1 で実行全体のcProfileを{METRICS_DIR}/{job}.pstatsに出力する
+PROFILE_ENABLED = os.environ.get('UAP_PROFILE', '0') == '1'
+
+# ヒストグラムのバケット(秒)
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # 最後は+Inf
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+        self.max = max(self.max, value)
+
+    # バケットから分位点を近似する
+    def quantile(self, q):
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            if cumulative >= rank:
+                return bound
+        return self.max
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+NULL_SPAN = _NullSpan()
+
+class _Span:
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.metrics.observe(self.name, time.perf_counter() - self.start)
+        if exc_type is not None:
+            self.metrics.count(f'{self.name}.errors')
+        return False
+
+class Metrics:
+    """
+    処理ごとの所要時間(ヒストグラム)と回数(カウンタ)を集計する
+      with metrics.span('fit.fetch_data'): ...
+      metrics.count('discord.member_edit')
+    実行の最後にexport(job)でPrometheusのtextfileとJSONのサマリを出力する
+    """
+    def __init__(self, enabled=METRICS_ENABLED, metrics_dir=METRICS_DIR, profile=PROFILE_ENABLED):
+        self.enabled = enabled
+        self.metrics_dir = metrics_dir
+        self.profile = profile
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.histograms = {}
+            self.counters = {}
+
+    def span(self, name):
+        if not self.enabled:
+            return NULL_SPAN
+        return _Span(self, name)
+
+    def observe(self, name, seconds):
+        if not self.enabled:
+            return
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(seconds)
+
+    def count(self, name, value=1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    @contextmanager
+    def run(self, job):
+        """1回の実行全体を計測し、抜ける時に結果を出力する（UAP_PROFILEならcProfileも）"""
+        if not self.enabled and not self.profile:
+            yield self
+            return
+        profiler = cProfile.Profile() if self.profile else None
+        if profiler is not None:
+            profiler.enable()
+        start = time.perf_counter()
+        try:
+            with self.span(f'{job}.run'):
+                yield self
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                os.makedirs(self.metrics_dir, exist_ok=True)
+                profiler.dump_stats(os.path.join(self.metrics_dir, f'{job}.pstats'))
+            if self.enabled:
+                self.export(job, time.perf_counter() - start)
+
+    def summary(self):
+        with self._lock:
+            return {
+                'counters': dict(self.counters),
+                'spans': {
+                    name: {
+                        'count': histogram.count,
+                        'sum_seconds': histogram.sum,
+                        'max_seconds': histogram.max,
+                        'p50_seconds': histogram.quantile(0.50),
+                        'p99_seconds': histogram.quantile(0.99)
+                    }
+                    for name, histogram in self.histograms.items()
+                }
+            }
+
+    def prometheus_text(self, job, duration):
+        lines = [
+            '# TYPE uap_span_seconds histogram',
+        ]
+        with self._lock:
+            for name, histogram in sorted(self.histograms.items()):
+                labels = f'job="{job}",span="{name}"'
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append(f'uap_span_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+                lines.append(f'uap_span_seconds_bucket{{{labels},le="+Inf"}} {histogram.count}')
+                lines.append(f'uap_span_seconds_sum{{{labels}}} {histogram.sum}')
+                lines.append(f'uap_span_seconds_count{{{labels}}} {histogram.count}')
+            lines.append('# TYPE uap_events_total counter')
+            for name, value in sorted(self.counters.items()):
+                lines.append(f'uap_events_total{{job="{job}",name="{name}"}} {value}')
+        lines.append('# TYPE uap_run_duration_seconds gauge')
+        lines.append(f'uap_run_duration_seconds{{job="{job}"}} {duration}')
+        lines.append('# TYPE uap_run_timestamp_seconds gauge')
+        lines.append(f'uap_run_timestamp_seconds{{job="{job}"}} {time.time()}')
+        return '\n'.join(lines) + '\n'
+
+    def export(self, job, duration=0.0):
+        """{metrics_dir}/{job}.prom と {metrics_dir}/{job}.json に出力する"""
+        os.makedirs(self.metrics_dir, exist_ok=True)
+        prom_path = os.path.join(self.metrics_dir, f'{job}.prom')
+        # node_exporterが書きかけのファイルを読まないように置き換える
+        with open(f'{prom_path}.tmp', 'w') as f:
+            f.write(self.prometheus_text(job, duration))
+        os.replace(f'{prom_path}.tmp', prom_path)
+        summary = self.summary()
+        summary['job'] = job
+        summary['duration_seconds'] = duration
+        with open(os.path.join(self.metrics_dir, f'{job}.json'), 'w') as f:
+            json.dump(summary, f, indent=2, ensure_ascii=False)
+
+# プロセス全体で共有する
+metrics = Metrics()
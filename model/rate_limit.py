@@ -0,0 +1,166 @@
+import os
+import random
+import socket
+import threading
+import time
+from googleapiclient.errors import HttpError
+from model.metrics import metrics
+
+# Fitness APIのクォータに合わせた設定（環境変数で上書き可能）
+FIT_PROJECT_QPS = float(os.environ.get('UAP_FIT_PROJECT_QPS', 50))
+FIT_USER_QPS = float(os.environ.get('UAP_FIT_USER_QPS', 5))
+FIT_MAX_RETRIES = int(os.environ.get('UAP_FIT_MAX_RETRIES', 5))
+FIT_BACKOFF_BASE = float(os.environ.get('UAP_FIT_BACKOFF_BASE', 0.5))
+FIT_BACKOFF_MAX = float(os.environ.get('UAP_FIT_BACKOFF_MAX', 32.0))
+FIT_MAX_CONCURRENCY = int(os.environ.get('UAP_FIT_MAX_CONCURRENCY', 32))
+
+# リトライするHTTPステータス（429はクォータ超過）
+RETRYABLE_STATUSES = (429, 500, 502, 503, 504)
+
+class TokenBucket:
+    """1秒あたりrate回まで（burst回までまとめて）許可する。トークンがなければ待つ"""
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or max(rate, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            wait = self.try_acquire()
+            if wait is None:
+                return
+            time.sleep(wait)
+
+    def try_acquire(self):
+        """待たずにトークンを1つ取る。取れたらNone、取れなければ次のトークンまでの秒数を返す"""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return None
+            return (1 - self.tokens) / self.rate
+
+class AimdLimiter:
+    """
+    同時実行数をAIMDで調整する
+    成功するたびに1/limitずつ増やし（limit回成功すると+1）、スロットリングされたら半分にする
+    """
+    def __init__(self, initial=4, minimum=1, maximum=FIT_MAX_CONCURRENCY):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.in_flight = 0
+        self._condition = threading.Condition()
+        # 同時に返ってきた429で何度も半分にしないよう、直前の減少以降に始まったリクエストだけを数える
+        self._decreased_at = 0.0
+
+    def acquire(self):
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+            return time.monotonic()
+
+    def release(self):
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify()
+
+    def on_success(self):
+        with self._condition:
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self._condition.notify()
+
+    def on_throttle(self, started):
+        with self._condition:
+            if started < self._decreased_at:
+                return
+            self.limit = max(self.minimum, self.limit / 2)
+            self._decreased_at = time.monotonic()
+
+class FitRateLimiter:
+    """
+    Fitness APIの呼び出しを、プロジェクト全体・ユーザごとのトークンバケットとAIMDの同時実行数で制限する
+    429/5xxと通信エラーは、ジッター付きの指数バックオフでリトライする
+    プロセス全体で1つを共有し、全ユーザ・全スレッドの呼び出しをまとめて制御する
+    """
+    def __init__(self, project_qps=FIT_PROJECT_QPS, user_qps=FIT_USER_QPS, max_retries=FIT_MAX_RETRIES,
+                 backoff_base=FIT_BACKOFF_BASE, backoff_max=FIT_BACKOFF_MAX, concurrency=None):
+        self.project_bucket = TokenBucket(project_qps)
+        self.user_qps = user_qps
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.concurrency = concurrency or AimdLimiter()
+        self._user_buckets = {}
+        self._lock = threading.Lock()
+        self.throttled = 0
+        self.retries = 0
+
+    def user_bucket(self, user_id):
+        with self._lock:
+            bucket = self._user_buckets.get(user_id)
+            if bucket is None:
+                bucket = self._user_buckets[user_id] = TokenBucket(self.user_qps)
+            return bucket
+
+    def backoff(self, attempt, retry_after=None):
+        # full jitter: 0からbase*2^attemptの間でランダムに待つ
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        if retry_after:
+            delay = max(delay, retry_after)
+        return delay
+
+    def call(self, user_id, request):
+        """request()を制限付きで実行し、リトライしても失敗した場合は最後の例外を投げる"""
+        user_bucket = self.user_bucket(user_id)
+        attempt = 0
+        while True:
+            wait_start = time.perf_counter()
+            user_bucket.acquire()
+            self.project_bucket.acquire()
+            started = self.concurrency.acquire()
+            metrics.observe('fit.rate_limit_wait', time.perf_counter() - wait_start)
+            try:
+                result = request()
+                self.concurrency.on_success()
+                return result
+            except HttpError as e:
+                status = e.resp.status
+                if status not in RETRYABLE_STATUSES or attempt >= self.max_retries:
+                    raise
+                if status == 429:
+                    with self._lock:
+                        self.throttled += 1
+                    metrics.count('fit.throttled')
+                    self.concurrency.on_throttle(started)
+                retry_after = self.retry_after(e)
+            except (socket.timeout, ConnectionError):
+                if attempt >= self.max_retries:
+                    raise
+                retry_after = None
+            finally:
+                self.concurrency.release()
+            with self._lock:
+                self.retries += 1
+            metrics.count('fit.retry')
+            time.sleep(self.backoff(attempt, retry_after))
+            attempt += 1
+
+    @staticmethod
+    def retry_after(error):
+        try:
+            return float(error.resp.get('retry-after'))
+        except (TypeError, ValueError):
+            return None
+
+    def stats(self):
+        return {
+            'concurrency_limit': round(self.concurrency.limit, 2),
+            'throttled': self.throttled,
+            'retries': self.retries
+        }
@@ -0,0 +1,67 @@
+import json
+import numpy as np
+import pandas as pd
+
+class RoleRuleEngine:
+    """
+    config/role_rules.jsonの段階的な閾値で、全ユーザのロールを一度に判定する
+    ルールは集計結果の列名ごとに定義する
+      at_least: 値が閾値以上の段階のうち、一番上の段階のロール
+      at_most:  値が閾値以下の段階のうち、一番下の段階のロール
+    """
+    RULES_FILE = 'config/role_rules.json'
+    ROLES_FILE = 'config/roles.json'
+
+    def __init__(self, rules, discord_roles):
+        self.rules = {}
+        for column, rule in rules.items():
+            tiers = sorted(rule['tiers'], key=lambda tier: tier['threshold'])
+            role_ids = []
+            for tier in tiers:
+                # roles.jsonにないロールは付与しない
+                role_id = discord_roles.get(tier['role'], 0)
+                if not role_id:
+                    print(f"ロール {tier['role']} がroles.jsonに見つかりません。")
+                role_ids.append(role_id)
+            self.rules[column] = (
+                rule['type'],
+                np.array([tier['threshold'] for tier in tiers], dtype='float64'),
+                np.array(role_ids, dtype='int64')
+            )
+
+    @classmethod
+    def from_config(cls, rules_file=RULES_FILE, roles_file=ROLES_FILE):
+        with open(rules_file, 'r') as f:
+            rules = json.load(f)
+        with open(roles_file, 'r') as f:
+            discord_roles = json.load(f)
+        return cls(rules, discord_roles)
+
+    def evaluate(self, stats, index='user_id'):
+        """
+        stats: ユーザごとの集計結果のDataFrame（1ユーザ1行）
+        ユーザ x ルール のrole_idの行列を返す。ロールがない場合は0
+        """
+        matrix = {}
+        for column, (rule_type, thresholds, role_ids) in self.rules.items():
+            values = stats[column].to_numpy(dtype='float64')
+            if rule_type == 'at_least':
+                tier = np.searchsorted(thresholds, values, side='right') - 1
+                matched = tier >= 0
+            elif rule_type == 'at_most':
+                tier = np.searchsorted(thresholds, values, side='left')
+                matched = tier < len(thresholds)
+            else:
+                raise ValueError(f"未対応のルールの種類です: {rule_type}")
+            matched &= ~np.isnan(values)
+            matrix[column] = np.where(matched, role_ids[np.clip(tier, 0, len(role_ids) - 1)], 0)
+        return pd.DataFrame(matrix, index=stats[index].to_numpy())
+
+    @staticmethod
+    def roles_per_user(matrix):
+        """行列を {user_id: [role_id, ...]} に変換する（ルールの定義順）"""
+        values = matrix.to_numpy()
+        return {
+            int(user_id): [int(role_id) for role_id in row if role_id]
+            for user_id, row in zip(matrix.index, values)
+        }
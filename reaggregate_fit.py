@@ -0,0 +1,45 @@
+from datetime import datetime, timezone
+import argparse
+from model.db import DatabaseClient
+from model.fit_archive import FitArchive, JST
+from model.metrics import metrics
+
+# Google Fitの生データのアーカイブからtbl_fitを作り直す（APIには接続しない）
+# 集計ルールやsteps_coefficientを変えた時に使う
+# steps,distance,weight,fatの全ての列をアーカイブの値で置き換える（未計測のweight,fatはNULLになる）
+# 使い方: python cli.py reaggregate --start 2024-11-01 --end 2024-12-01 [--group 1] [--insert-missing]
+#         python reaggregate_fit.py --start 2024-11-01 --end 2024-12-01 [--group 1] [--insert-missing]
+def main(group_id, start, end, insert_missing=False, db_client=None, archive=None):
+    # start, endはJSTの日付(YYYY-MM-DD)、endの日は含まない
+    start_date = datetime.strptime(start, '%Y-%m-%d').replace(tzinfo=JST).astimezone(timezone.utc)
+    end_date = datetime.strptime(end, '%Y-%m-%d').replace(tzinfo=JST).astimezone(timezone.utc)
+    days = (end_date - start_date).days
+
+    # db: INSTANCE GENERATION
+    db_client = db_client or DatabaseClient()
+    
+    # db: group_idを指定して所属する全てのユーザ情報を取得
+    users = db_client.get_users_by_group(group_id)
+
+    # archive: ユーザごとに日単位で集計し直す
+    archive = archive or FitArchive()
+    fit_data_list = []
+    for user in users:
+        for fit_data in archive.aggregate_days(user.user_id, start_date, days):
+            fit_data['steps'] *= user.steps_coefficient #steps補正
+            fit_data_list.append(fit_data)
+
+    # db: 全ての列をまとめて書き込む
+    inserted, updated = db_client.bulk_upsert_fit_data(fit_data_list, insert_missing=insert_missing)
+    print(f"追加: {inserted}件, 更新: {updated}件")
+    return inserted, updated
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='アーカイブからtbl_fitを作り直す')
+    parser.add_argument('--group', type=int, default=1)
+    parser.add_argument('--start', required=True, help='開始日(JST, YYYY-MM-DD)')
+    parser.add_argument('--end', required=True, help='終了日(JST, YYYY-MM-DD, この日は含まない)')
+    parser.add_argument('--insert-missing', action='store_true', help='tbl_fitにない日も追加する')
+    args = parser.parse_args()
+    with metrics.run('reaggregate_fit'):
+        main(args.group, args.start, args.end, args.insert_missing)
@@ -0,0 +1,80 @@
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import json
+import os
+from model.db import DatabaseClient, get_pool_stats
+from model.metrics import metrics
+
+# tbl_groupの全グループに対して毎日の処理を並列に実行する
+# グループごとの処理: ingest(前日のfitデータ) -> update(遅れて届いたfitデータ) -> judge(ロール判定)
+# 最後に成功したグループのDiscordのロールを1回のBotのログインでまとめて同期する
+STAGES = ('ingest', 'update', 'judge', 'sync-roles')
+
+# 同時に処理するグループ数の上限（環境変数で上書き可能）
+MAX_PARALLEL_GROUPS = int(os.environ.get('UAP_MAX_PARALLEL_GROUPS', 4))
+
+# グループごとの設定（同時にGoogle Fitへ問い合わせるユーザ数など）
+GROUPS_CONFIG_FILE = 'config/groups.json'
+
+def load_group_config():
+    if not os.path.exists(GROUPS_CONFIG_FILE):
+        return {}
+    with open(GROUPS_CONFIG_FILE, 'r') as f:
+        return json.load(f)
+
+def run_group(group_id, stages, group_config):
+    max_workers = group_config.get('max_workers')
+    if 'ingest' in stages:
+        import uap
+        with metrics.span('stage.ingest'):
+            ingest_result = uap.main(group_id, max_workers)
+        print(f"group {group_id}: ingest 失敗したユーザ {list(ingest_result.errors)}")
+    if 'update' in stages:
+        import update_fit_data
+        with metrics.span('stage.update'):
+            ingest_result = update_fit_data.main(group_id, max_workers)
+        print(f"group {group_id}: update 失敗したユーザ {list(ingest_result.errors)}")
+    if 'judge' in stages:
+        import judge_role
+        with metrics.span('stage.judge'):
+            judge_role.main(group_id)
+
+def main():
+    parser = argparse.ArgumentParser(description='全グループの毎日の処理を並列に実行する')
+    parser.add_argument('stages', nargs='*', help=f'実行する処理 {STAGES}（省略時は全て）')
+    parser.add_argument('--max-parallel-groups', type=int, default=MAX_PARALLEL_GROUPS)
+    args = parser.parse_args()
+    for stage in args.stages:
+        if stage not in STAGES:
+            parser.error(f"不明な処理です: {stage}")
+    args.stages = args.stages or list(STAGES)
+
+    # db: 全グループを取得
+    groups = DatabaseClient().get_all_groups()
+    group_config = load_group_config()
+
+    # グループごとに並列に実行し、1つのグループの失敗は他のグループに影響させない
+    succeeded_group_ids = []
+    with ThreadPoolExecutor(max_workers=args.max_parallel_groups) as executor:
+        futures = {
+            group.group_id: executor.submit(run_group, group.group_id, args.stages, group_config.get(str(group.group_id), {}))
+            for group in groups
+        }
+        for group_id, future in futures.items():
+            try:
+                future.result()
+                succeeded_group_ids.append(group_id)
+            except Exception as e:
+                print(f"group {group_id} の処理に失敗しました: {e}")
+
+    if 'sync-roles' in args.stages and succeeded_group_ids:
+        import discord_role_master
+        with metrics.span('stage.sync-roles'):
+            discord_role_master.main(succeeded_group_ids)
+
+    # db: コネクションプールの統計を表示（プールのサイズ調整用）
+    print(f"DB pool: {get_pool_stats()}")
+
+if __name__ == "__main__":
+    with metrics.run('run_groups'):
+        main()
@@ -0,0 +1,37 @@
+from datetime import datetime
+import pytest
+from sqlalchemy import create_engine, insert, select
+from sqlalchemy.orm import sessionmaker
+from model.db import Base, DatabaseClient, FitData, Group, User
+
+# weight,fatが未計測(0)の日はNULLで保存され、直近の体重の引き継ぎ元にならないことを確認する
+
+@pytest.fixture
+def db_client(tmp_path):
+    engine = create_engine(f'sqlite:///{tmp_path / "uap.db"}')
+    Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        connection.execute(insert(Group), [{'group_id': 1, 'group_name': 'group1', 'discord_guild_id': 1}])
+        connection.execute(insert(User), [{'user_id': 1, 'user_name': 'user1', 'group_id': 1, 'discord_user_id': 1,
+                                           'steps_coefficient': 1.0}])
+    return DatabaseClient(sessionmaker(bind=engine))
+
+def fit_data(day, weight, fat):
+    return {'user_id': 1, 'datetime': datetime(2025, 1, day, 15), 'steps': 100, 'distance': 1.0,
+            'weight': weight, 'body_fat_percentage': fat}
+
+def test_unmeasured_days_are_stored_as_null(db_client):
+    db_client.bulk_upsert_fit_data([fit_data(1, 60.0, 20.0), fit_data(2, 0.0, 0.0)], update_columns=('steps', 'distance'))
+    rows = db_client.session.execute(select(FitData.weight, FitData.fat).order_by(FitData.datetime)).all()
+    assert [tuple(row) for row in rows] == [(60.0, 20.0), (None, None)]
+
+def test_latest_body_data_skips_null_and_zero(db_client):
+    assert db_client.get_latest_user_body_data(1) is None
+
+    db_client.bulk_upsert_fit_data([fit_data(1, 60.0, 20.0), fit_data(3, 0.0, 0.0)])
+    # 以前のbackfillで0のまま保存された行も飛ばす
+    db_client.session.execute(insert(FitData), [{'user_id': 1, 'datetime': datetime(2025, 1, 2, 15), 'steps': 100,
+                                                  'distance': 1.0, 'weight': 0.0, 'fat': 0.0}])
+    db_client.session.commit()
+    latest = db_client.get_latest_user_body_data(1)
+    assert (latest.weight, latest.fat) == (60.0, 20.0)
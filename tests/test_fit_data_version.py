@@ -0,0 +1,45 @@
+from datetime import datetime
+import pytest
+from sqlalchemy import create_engine, insert
+from sqlalchemy.orm import sessionmaker
+from model.db import Base, DatabaseClient, Group, User
+
+# tbl_fitを書き込むと、書き込んだユーザのグループのversionだけがcommit後に増えることを確認する
+
+@pytest.fixture
+def db_client(tmp_path):
+    engine = create_engine(f'sqlite:///{tmp_path / "uap.db"}')
+    Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        connection.execute(insert(Group), [
+            {'group_id': group_id, 'group_name': f'group{group_id}', 'discord_guild_id': group_id} for group_id in (1, 2)
+        ])
+        connection.execute(insert(User), [
+            {'user_id': user_id, 'user_name': f'user{user_id}', 'group_id': user_id, 'discord_user_id': user_id,
+             'steps_coefficient': 1.0}
+            for user_id in (1, 2)
+        ])
+    return DatabaseClient(sessionmaker(bind=engine))
+
+def fit_data(user_id, day, steps):
+    return {'user_id': user_id, 'datetime': datetime(2025, 1, day, 15), 'steps': steps, 'distance': 1.0,
+            'weight': 60.0, 'body_fat_percentage': 20.0}
+
+def test_version_is_per_group(db_client):
+    db_client.bulk_upsert_fit_data([fit_data(1, 1, 100)])
+    db_client.bulk_upsert_fit_data([fit_data(1, 2, 100)])
+    assert db_client.get_fit_data_version(1)[0] == 2
+    assert db_client.get_fit_data_version(2)[0] == 0
+
+def test_version_is_bumped_after_commit_only(db_client):
+    with pytest.raises(RuntimeError):
+        with db_client.unit_of_work():
+            db_client.bulk_upsert_fit_data([fit_data(2, 1, 100)])
+            raise RuntimeError('rollback')
+    assert db_client.get_fit_data_version(2)[0] == 0
+
+    with db_client.unit_of_work():
+        db_client.bulk_upsert_fit_data([fit_data(2, 1, 100)])
+        db_client.bulk_upsert_fit_data([fit_data(2, 2, 100)])
+    # 1つのトランザクションでは1回だけ増える
+    assert db_client.get_fit_data_version(2)[0] == 1
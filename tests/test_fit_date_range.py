@@ -0,0 +1,85 @@
+from datetime import datetime
+import pytest
+from sqlalchemy import create_engine, insert, select, text
+from model.db import Base, Group, User, FitData, fit_data_between, get_month_range, get_current_month_range, get_day_range
+
+# fit_data_betweenの半開区間[start, end)が月・日・年の境界の行を正しく含めるか、
+# idx_user_datetimeの範囲検索になっているかをSQLiteで確認する
+
+USER_ID = 1
+OTHER_USER_ID = 2
+
+BOUNDARY_DATETIMES = [
+    datetime(2024, 11, 30, 23, 59, 59),
+    datetime(2024, 12, 1, 0, 0, 0),
+    datetime(2024, 12, 31, 15, 0, 0),
+    datetime(2024, 12, 31, 23, 59, 59, 999999),
+    datetime(2025, 1, 1, 0, 0, 0),
+    datetime(2025, 1, 1, 15, 0, 0),
+    datetime(2025, 1, 2, 0, 0, 0),
+    datetime(2025, 1, 31, 23, 59, 59),
+    datetime(2025, 2, 1, 0, 0, 0),
+]
+
+@pytest.fixture
+def engine():
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        connection.execute(insert(Group), [{'group_id': 1, 'group_name': 'group', 'discord_guild_id': 1}])
+        connection.execute(insert(User), [
+            {'user_id': user_id, 'user_name': f'user{user_id}', 'group_id': 1, 'discord_user_id': user_id,
+             'steps_coefficient': 1.0}
+            for user_id in (USER_ID, OTHER_USER_ID)
+        ])
+        connection.execute(insert(FitData), [
+            {'user_id': user_id, 'datetime': dt, 'steps': 0}
+            for user_id in (USER_ID, OTHER_USER_ID) for dt in BOUNDARY_DATETIMES
+        ])
+    return engine
+
+def select_between(engine, start, end):
+    stmt = select(FitData.datetime).where(fit_data_between(USER_ID, start, end)).order_by(FitData.datetime)
+    with engine.connect() as connection:
+        return connection.execute(stmt).scalars().all()
+
+def test_month_range(engine):
+    assert select_between(engine, *get_month_range(datetime(2025, 1, 15))) == [
+        datetime(2025, 1, 1, 0, 0, 0),
+        datetime(2025, 1, 1, 15, 0, 0),
+        datetime(2025, 1, 2, 0, 0, 0),
+        datetime(2025, 1, 31, 23, 59, 59),
+    ]
+
+def test_december_range_ends_on_jan_1(engine):
+    start, end = get_month_range(datetime(2024, 12, 10))
+    assert (start, end) == (datetime(2024, 12, 1), datetime(2025, 1, 1))
+    assert select_between(engine, start, end) == [
+        datetime(2024, 12, 1, 0, 0, 0),
+        datetime(2024, 12, 31, 15, 0, 0),
+        datetime(2024, 12, 31, 23, 59, 59, 999999),
+    ]
+
+def test_current_month_on_jan_1_is_last_december(engine):
+    start, end = get_current_month_range(datetime(2025, 1, 1, 10, 0, 0))
+    assert (start, end) == (datetime(2024, 12, 1), datetime(2025, 1, 1))
+    assert get_current_month_range(datetime(2025, 1, 2, 10, 0, 0)) == get_month_range(datetime(2025, 1, 1))
+
+def test_day_range(engine):
+    assert select_between(engine, *get_day_range(datetime(2025, 1, 1, 12, 0, 0))) == [
+        datetime(2025, 1, 1, 0, 0, 0),
+        datetime(2025, 1, 1, 15, 0, 0),
+    ]
+    assert select_between(engine, *get_day_range(datetime(2024, 12, 31))) == [
+        datetime(2024, 12, 31, 15, 0, 0),
+        datetime(2024, 12, 31, 23, 59, 59, 999999),
+    ]
+
+def test_range_uses_user_datetime_index(engine):
+    start, end = get_month_range(datetime(2025, 1, 15))
+    stmt = select(FitData).where(fit_data_between(USER_ID, start, end))
+    sql = str(stmt.compile(engine, compile_kwargs={'literal_binds': True}))
+    with engine.connect() as connection:
+        plan = ' '.join(row[-1] for row in connection.execute(text(f'EXPLAIN QUERY PLAN {sql}')))
+    # (user_id, datetime)の複合インデックスで、user_idの一致とdatetimeの範囲を検索している
+    assert 'SEARCH' in plan and 'user_id=?' in plan and 'datetime>?' in plan and 'datetime<?' in plan, plan
@@ -0,0 +1,49 @@
+from datetime import datetime
+import pytest
+from sqlalchemy import create_engine, insert, select
+from sqlalchemy.orm import sessionmaker
+from model.db import Base, DatabaseClient, FitMonthly, Group, User, get_whole_month_range
+
+# 月単位の表示を月次集計(tbl_fit_monthly)から読んでも、tbl_fitから集計した結果と同じになることを確認する
+
+@pytest.fixture
+def db_client(tmp_path):
+    engine = create_engine(f'sqlite:///{tmp_path / "uap.db"}')
+    Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        connection.execute(insert(Group), [{'group_id': 1, 'group_name': 'group1', 'discord_guild_id': 1}])
+        connection.execute(insert(User), [
+            {'user_id': user_id, 'user_name': f'user{user_id}', 'group_id': 1, 'discord_user_id': user_id,
+             'steps_coefficient': 1.0}
+            for user_id in (1, 2)
+        ])
+    return DatabaseClient(sessionmaker(bind=engine))
+
+def fit_data(user_id, month, day, steps, weight=0.0):
+    return {'user_id': user_id, 'datetime': datetime(2025, month, day, 15), 'steps': steps, 'distance': steps / 1000,
+            'weight': weight, 'body_fat_percentage': weight / 3}
+
+def test_running_totals_follow_earlier_months(db_client):
+    db_client.bulk_upsert_fit_data([fit_data(1, 3, 1, 3000), fit_data(1, 4, 1, 4000)])
+    # 前の月を後から書き込むと、それ以降の月の累計も変わる
+    db_client.bulk_upsert_fit_data([fit_data(1, 1, 10, 1000), fit_data(1, 1, 11, 500)])
+    rows = db_client.session.execute(
+        select(FitMonthly.month, FitMonthly.total_steps, FitMonthly.running_steps).order_by(FitMonthly.month)).all()
+    assert [(row.month.month, row.total_steps, row.running_steps) for row in rows] == [
+        (1, 1500, 1500), (3, 3000, 4500), (4, 4000, 8500)]
+
+def test_month_series_matches_fit_data(db_client):
+    db_client.bulk_upsert_fit_data([
+        fit_data(1, 1, 10, 1000, 60.0), fit_data(1, 1, 20, 2000), fit_data(1, 2, 5, 3000, 61.0),
+        fit_data(1, 3, 5, 4000, 62.0), fit_data(2, 2, 1, 500), fit_data(2, 3, 31, 700, 50.0)
+    ])
+    start, end = datetime(2025, 2, 1), datetime(2025, 4, 1)
+    from_monthly = db_client.get_group_fit_series(1, start, end, 'month')
+    # 月の途中から始まる期間はtbl_fitから集計する
+    from_fit_data = db_client.get_group_fit_series(1, start, datetime(2025, 3, 31, 23), 'month')
+    assert from_monthly['cumulative_steps'].tolist() == [3000, 7000, 500, 1200]
+    assert from_monthly.equals(from_fit_data)
+
+def test_whole_month_range():
+    assert get_whole_month_range(datetime(2025, 1, 10), datetime(2025, 2, 1)) == (datetime(2025, 1, 1), datetime(2025, 2, 1))
+    assert get_whole_month_range(datetime(2024, 12, 31), datetime(2025, 1, 2)) == (datetime(2024, 12, 1), datetime(2025, 2, 1))
@@ -0,0 +1,57 @@
+import threading
+import time
+from types import SimpleNamespace
+from model import ingest
+from model.ingest import FitIngestor
+
+# 複数の取り込みを並列に実行しても、共有のスレッドプールより多くは同時に取得しないことを確認する
+
+class ConcurrencyProbe:
+    """client_factoryの代わりに使い、同時に取得しているユーザ数の最大を記録する"""
+    def __init__(self):
+        self.active = 0
+        self.peak = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, user_id):
+        return SimpleNamespace(user_id=user_id, probe=self)
+
+    def fetch(self, gf_client):
+        with self._lock:
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+        time.sleep(0.01)
+        with self._lock:
+            self.active -= 1
+        return [{'user_id': gf_client.user_id, 'steps': 100}]
+
+def users(count):
+    return [SimpleNamespace(user_id=user_id, steps_coefficient=1.0) for user_id in range(count)]
+
+def test_run_submits_at_most_max_workers_users():
+    probe = ConcurrencyProbe()
+    result = FitIngestor(3, client_factory=probe).run(users(10), probe.fetch)
+    assert [fit_data['user_id'] for fit_data in result.fit_data_list] == list(range(10))
+    assert probe.peak <= 3
+
+def test_parallel_groups_share_one_pool():
+    probe = ConcurrencyProbe()
+    groups = [threading.Thread(target=FitIngestor(client_factory=probe).run, args=(users(ingest.FIT_MAX_CONCURRENCY), probe.fetch))
+              for _ in range(4)]
+    for group in groups:
+        group.start()
+    for group in groups:
+        group.join()
+    assert probe.peak <= ingest.FIT_MAX_CONCURRENCY
+    assert ingest.get_executor()._max_workers == ingest.FIT_MAX_CONCURRENCY
+
+def test_stream_stops_producers_when_closed():
+    probe = ConcurrencyProbe()
+    def fetch(gf_client):
+        for _ in range(100):
+            yield from probe.fetch(gf_client)
+    records = FitIngestor(2, client_factory=probe).stream(users(5), fetch)
+    next(records)
+    records.close()
+    # closeした時点で取得中のユーザは止まっている
+    assert probe.active == 0
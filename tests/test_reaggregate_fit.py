@@ -0,0 +1,46 @@
+from datetime import datetime, timedelta, timezone
+import pytest
+from sqlalchemy import create_engine, insert, select
+from sqlalchemy.orm import sessionmaker
+import reaggregate_fit
+from model.db import Base, DatabaseClient, FitData, Group, User
+from model.fit_archive import FitArchive, JST
+
+# アーカイブからtbl_fitを作り直すと、steps,distanceだけでなくweight,fatも置き換わることを確認する
+
+START = datetime(2025, 1, 1, tzinfo=JST).astimezone(timezone.utc)
+
+@pytest.fixture
+def db_client(tmp_path):
+    engine = create_engine(f'sqlite:///{tmp_path / "uap.db"}')
+    Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        connection.execute(insert(Group), [{'group_id': 1, 'group_name': 'group1', 'discord_guild_id': 1}])
+        connection.execute(insert(User), [{'user_id': 1, 'user_name': 'user1', 'group_id': 1, 'discord_user_id': 1,
+                                           'steps_coefficient': 1.0}])
+    return DatabaseClient(sessionmaker(bind=engine))
+
+def point(day, hour, value):
+    start = START + timedelta(days=day, hours=hour)
+    return {'startTimeNanos': str(int(start.timestamp() * 1e9)),
+            'endTimeNanos': str(int((start + timedelta(minutes=1)).timestamp() * 1e9)), 'value': [value]}
+
+def test_reaggregate_rebuilds_all_columns(db_client, tmp_path):
+    archive = FitArchive(str(tmp_path / 'archive'))
+    end = START + timedelta(days=2)
+    archive.write(1, 'steps', [point(0, 10, {'intVal': 1000}), point(1, 10, {'intVal': 2000})], START, end)
+    archive.write(1, 'distance', [point(0, 10, {'fpVal': 800.0}), point(1, 10, {'fpVal': 1600.0})], START, end)
+    archive.write(1, 'weights', [point(0, 7, {'fpVal': 61.0})], START, end)
+    archive.write(1, 'body_fat', [point(0, 7, {'fpVal': 21.0})], START, end)
+    # アーカイブと違う値で保存されている行を置き換える
+    db_client.bulk_upsert_fit_data([
+        {'user_id': 1, 'datetime': START + timedelta(days=day + 1), 'steps': 1, 'distance': 0.1,
+         'weight': 70.0, 'body_fat_percentage': 30.0}
+        for day in range(2)
+    ])
+
+    assert reaggregate_fit.main(1, '2025-01-01', '2025-01-03', db_client=db_client, archive=archive) == (0, 2)
+
+    rows = db_client.session.execute(
+        select(FitData.steps, FitData.distance, FitData.weight, FitData.fat).order_by(FitData.datetime)).all()
+    assert [tuple(row) for row in rows] == [(1000, 0.8, 61.0, 21.0), (2000, 1.6, None, None)]
@@ -0,0 +1,85 @@
+from datetime import timedelta
+import pytest
+from sqlalchemy import create_engine, insert, select, delete
+from sqlalchemy.orm import sessionmaker
+from benchmark.fake_fit_api import FakeFitApi
+from model.db import Base, DatabaseClient, Group, User, FitData
+from model.google_fit import GoogleFitClient
+import update_fit_data
+
+# 偽のFitness APIとSQLiteで、watermarkによる差分同期(update_fit_data)を確認する
+
+USER_ID = 1
+STEPS_SOURCE = GoogleFitClient.DATA_SOURCES['steps']
+
+@pytest.fixture
+def db_client(tmp_path):
+    engine = create_engine(f'sqlite:///{tmp_path / "uap.db"}')
+    Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        connection.execute(insert(Group), [{'group_id': 1, 'group_name': 'group', 'discord_guild_id': 1}])
+        connection.execute(insert(User), [{'user_id': USER_ID, 'user_name': 'user', 'group_id': 1,
+                                           'discord_user_id': 1, 'steps_coefficient': 1.0}])
+    return DatabaseClient(sessionmaker(bind=engine))
+
+@pytest.fixture
+def api():
+    return FakeFitApi(latency=0)
+
+def run(db_client, api):
+    return update_fit_data.main(1, db_client=db_client, client_factory=api.client_factory())
+
+def steps_by_day(db_client):
+    rows = db_client.session.execute(select(FitData.datetime, FitData.steps).where(FitData.user_id == USER_ID)).all()
+    db_client.session.close()
+    return {row.datetime.date(): row.steps for row in rows}
+
+def test_first_sync_inserts_recent_days_and_sets_watermarks(db_client, api):
+    result = run(db_client, api)
+    assert not result.errors
+    assert len(steps_by_day(db_client)) == 4
+    assert set(db_client.get_sync_watermarks(USER_ID)) == set(GoogleFitClient.DATA_SOURCES.values())
+
+def test_sync_without_changes_fetches_no_datasets(db_client, api):
+    run(db_client, api)
+    api.reset_stats()
+    result = run(db_client, api)
+    assert result.fit_data_list == []
+    # data sourceごとにdataPointChangesを1回読むだけ
+    assert api.stats()['requests'] == len(GoogleFitClient.DATA_SOURCES)
+
+def test_late_point_older_than_any_window_is_counted(db_client, api):
+    run(db_client, api)
+    before = steps_by_day(db_client)
+    gf_client = api.client_factory()(USER_ID)
+    day_start, _ = gf_client.get_past_dates(10)
+    start_nanos = int((day_start + timedelta(hours=3)).timestamp() * 1e9)
+    api.add_late_point(USER_ID, STEPS_SOURCE, start_nanos, start_nanos + 60 * 10**9, {'intVal': 1234})
+
+    result = run(db_client, api)
+    after = steps_by_day(db_client)
+    # 10日前の日だけを集計し直して追加する
+    assert len(result.fit_data_list) == 1
+    late_day = (day_start + timedelta(days=1)).date()
+    assert set(after) == set(before) | {late_day}
+    assert after[late_day] == gf_client.fetch_range_data(day_start, 1)[0]['steps']
+
+def test_watermark_moves_past_a_day_without_a_row(db_client, api):
+    run(db_client, api)
+    gf_client = api.client_factory()(USER_ID)
+    day_start, day_end = gf_client.get_past_dates(2)
+    day = day_end.date()
+    # 日の行を消してから、その日に遅れて届いたpointを追加する
+    with db_client.unit_of_work():
+        db_client.session.execute(delete(FitData).where(FitData.user_id == USER_ID))
+    watermark = db_client.get_sync_watermarks(USER_ID)[STEPS_SOURCE]
+    start_nanos = int((day_start + timedelta(hours=5)).timestamp() * 1e9)
+    api.add_late_point(USER_ID, STEPS_SOURCE, start_nanos, start_nanos + 60 * 10**9, {'intVal': 500})
+
+    run(db_client, api)
+    assert day in steps_by_day(db_client)
+    assert db_client.get_sync_watermarks(USER_ID)[STEPS_SOURCE] > watermark
+
+    # 書き込んだ変更は次回読み直さない
+    api.reset_stats()
+    assert run(db_client, api).fit_data_list == []
@@ -1,37 +1,40 @@
 from model.db import DatabaseClient
-from model.google_fit import GoogleFitClient
+from model.ingest import FitIngestor
+from model.metrics import metrics
 from datetime import datetime, timedelta
 
 # 毎日定期実行される内容を記述する
-def main():
+def main(group_id=1, max_workers=None):
     # db: INSTANCE GENERATION
     db_client = DatabaseClient()
     
     # db: group_idを指定して所属する全てのユーザ情報を取得
-    users = db_client.get_users_by_group(1)
+    users = db_client.get_users_by_group(group_id)
         
-    # gf: 各ユーザのfit_dataを取得してリスト化
-    fit_data_list = []
-    for user in users:
-        gf_client = GoogleFitClient(user.user_id)
-        gf_data = gf_client.fetch_combined_data()
-        gf_data['steps'] *= user.steps_coefficient #steps補正
-        fit_data_list.append(gf_data)
+    # gf: 各ユーザのfit_dataを並列に取得してリスト化
+    ingest_result = FitIngestor(max_workers).run_daily(users)
+    fit_data_list = ingest_result.fit_data_list
+    for gf_data in fit_data_list:
         print(gf_data)
     
     # db: weight,fatが未更新の場合は直近のデータを引き継ぎ
+    # 未計測の日(NULL/0)は飛ばして、最後にweightが記録された日の値を使う
     for fit_data in fit_data_list:
         if fit_data['weight'] == 0.0: # MEMO: fatだけ記録されることはないはず
-            latest_fit_data = db_client.get_latest_user_fit_data(fit_data['user_id'])
-            fit_data['weight'] = latest_fit_data.weight
-            fit_data['body_fat_percentage'] = latest_fit_data.fat
+            latest_fit_data = db_client.get_latest_user_body_data(fit_data['user_id'])
+            if latest_fit_data is not None:
+                fit_data['weight'] = latest_fit_data.weight
+                fit_data['body_fat_percentage'] = latest_fit_data.fat
     
     # db: fit_date_listをdbへ書き込む
     # fitdataを取得する時間が早すぎると正しい値が取得できないので、
     # 朝10時にこのコードを実行するが、前日のデータを取得するのでdbに書き込む値はずらす
     # datetime_db = datetime.now() - timedelta(hours=2)
     # for fit_data in fit_data_list:
-    #     db_client.add_fit_data(fit_data, datetime_db)
-    
+    #     fit_data['datetime'] = datetime_db
+    # db_client.bulk_upsert_fit_data(fit_data_list)
+    return ingest_result
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    with metrics.run('uap'):
+        main()
\ No newline at end of file
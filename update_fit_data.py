@@ -1,27 +1,37 @@
 from model.db import DatabaseClient
 from model.google_fit import GoogleFitClient
+from model.ingest import FitIngestor
+from model.metrics import metrics
 
 # 毎日定期実行される内容を記述する
-def main():
+def main(group_id=1, max_workers=None, db_client=None, client_factory=GoogleFitClient):
     # db: INSTANCE GENERATION
-    db_client = DatabaseClient()
+    db_client = db_client or DatabaseClient()
     
     # db: group_idを指定して所属する全てのユーザ情報を取得
-    users = db_client.get_users_by_group(1)
+    users = db_client.get_users_by_group(group_id)
     
-    # gf: 過去のfitデータをまとめて取得
-    gf_data_list = []
-    for user in users:
-        gf_client = GoogleFitClient(user.user_id)
-        gf_data = gf_client.fetch_past_data(5)
-        for gfd in gf_data:
-            gfd['steps'] *= user.steps_coefficient #steps補正
-        print(gf_data)
-        gf_data_list += gf_data #　一つのリストにまとめる
+    # db: 前回どこまで同期したか(watermark)をユーザごとに取得
+    watermarks_by_user = {user.user_id: db_client.get_sync_watermarks(user.user_id) for user in users}
     
-    # db: update
-    for gf_data in gf_data_list:
-        db_client.update_fit_data(gf_data)
+    # gf: 前回の同期以降に変化のあった日のfitデータだけを全ユーザ分並列に取得
+    ingest_result = FitIngestor(max_workers, client_factory=client_factory).run_incremental(users, watermarks_by_user)
+    gf_data_list = ingest_result.fit_data_list
+    print(gf_data_list)
     
+    # db: fitデータの更新とwatermarkの更新を1つのトランザクションで書き込む
+    # 書き込みに失敗した場合はwatermarkも進まない
+    with db_client.unit_of_work():
+        # db: steps,distanceをまとめて更新（tbl_fitに行がない日は追加する）
+        # 変更を読んだ日は全て書き込むので、watermarkはその日より先に進めてよい
+        inserted, updated = db_client.bulk_upsert_fit_data(gf_data_list, update_columns=('steps', 'distance'))
+        print(f"追加: {inserted}件, 更新: {updated}件")
+        
+        # db: watermarkを進める
+        for user_id, watermarks in ingest_result.watermarks.items():
+            db_client.update_sync_watermarks(user_id, watermarks)
+    return ingest_result
+
 if __name__ == "__main__":
-    main()
+    with metrics.run('update_fit_data'):
+        main()